@@ -0,0 +1,157 @@
+'''
+Benchmarks of the lane detection pipeline on recorded footage
+
+usage: python3 benchmarks.py [footage/7_edit.avi]
+'''
+
+import sys
+import time
+
+import cv2
+import numpy as np
+
+import binarization_utils
+import line_utils
+from line_utils import Line, compute_offset_from_center
+from globals import time_window
+from perspective_utils import region_of_interest, get_birds_eye_view
+
+
+def read_birds_eye_frames(video_file, max_frames=None):
+    """
+    Read a recording and warp every frame to the bird's eye view.
+
+    :param video_file: recorded footage
+    :param max_frames: maximum number of frames to read
+    :return: list of bird's eye view frames
+    """
+    cap = cv2.VideoCapture(video_file)
+    frames = []
+
+    while cap.isOpened() and (max_frames is None or len(frames) < max_frames):
+        ret, frame = cap.read()
+        if not ret:
+            break
+
+        src_pts, dst_pts = region_of_interest(frame)
+        warped, _, _ = get_birds_eye_view(frame, src_pts, dst_pts)
+        frames.append(warped)
+
+    cap.release()
+
+    return frames
+
+
+def benchmark_processing_scale(video_file, scales=(1.0, 0.5, 0.25), max_frames=300):
+    """
+    Accuracy versus latency of binarization and lane fitting at several processing scales.
+
+    Accuracy is measured against the first scale: mean absolute difference of the lane-line
+    positions at the bottom of the frame, and of the offset from the lane center.
+
+    :param video_file: recorded footage
+    :param scales: processing scales to compare, the first one is the reference
+    :param max_frames: maximum number of frames used
+    :return: dict of scale -> (ms per frame, lane position error in pixels, offset error in meters), errors
+             are NaN if no frame had the lines at both scales
+    """
+    frames = read_birds_eye_frames(video_file, max_frames)
+    height, width = frames[0].shape[:2]
+
+    reference_positions = None
+    reference_offsets = None
+    results = {}
+
+    for scale in scales:
+        line_lt, line_rt = Line(buffer_len=time_window), Line(buffer_len=time_window)
+        latencies = []
+        positions = []
+        offsets = []
+
+        for frame in frames:
+            start = time.perf_counter()
+
+            img_binary = binarization_utils.binarize(frame, verbose=False, scale=scale, full_resolution=False)
+            line_lt, line_rt, _ = line_utils.fit_by_sliding_windows(img_binary, line_lt, line_rt, n_windows=9,
+                                                                    scale=scale)
+
+            latencies.append(time.perf_counter() - start)
+
+            # frames where a line was never found do not count towards the errors
+            positions.append([np.nan if line.last_fit_pixel is None else np.polyval(line.last_fit_pixel, height - 1)
+                              for line in (line_lt, line_rt)])
+            offset = compute_offset_from_center(line_lt, line_rt, frame_width=width)
+            offsets.append(np.nan if offset < 0 else offset)
+
+        positions = np.array(positions)
+        offsets = np.array(offsets)
+
+        if reference_positions is None:
+            reference_positions, reference_offsets = positions, offsets
+
+        latency = 1000 * np.mean(latencies)
+        position_error = np.nanmean(np.abs(positions - reference_positions))
+        offset_error = np.nanmean(np.abs(offsets - reference_offsets))
+        results[scale] = (latency, position_error, offset_error)
+
+        print('scale %.2f: %6.2f ms/frame (%5.1f fps), lane position error %6.2f px, offset error %.3f m'
+              % (scale, latency, 1000 / latency, position_error, offset_error))
+
+    return results
+
+
+def benchmark_previous_fits(video_file, max_frames=300, repeats=10):
+    """
+    Per-frame cost of selecting lane pixels around the previous fits, row-band gather versus
+    testing every nonzero pixel. Also checks that both select exactly the same pixels.
+
+    :param video_file: recorded footage
+    :param max_frames: maximum number of frames used
+    :param repeats: number of timed runs per frame
+    :return: ms per frame of the reference and of the row-band method, number of mismatching frames
+    """
+    frames = read_birds_eye_frames(video_file, max_frames)
+    margin = 100
+
+    line_lt, line_rt = Line(buffer_len=time_window), Line(buffer_len=time_window)
+    timings = {line_utils.get_band_pixels_reference: [], line_utils.get_band_pixels: []}
+    mismatches = 0
+
+    for frame in frames:
+        img_binary = binarization_utils.binarize(frame, verbose=False)
+        line_lt, line_rt, _ = line_utils.fit_by_sliding_windows(img_binary, line_lt, line_rt, n_windows=9)
+        fits = [line_lt.last_fit_pixel, line_rt.last_fit_pixel]
+        if fits[0] is None or fits[1] is None:
+            continue
+
+        selections = {}
+        for method in timings:
+            start = time.perf_counter()
+            for _ in range(repeats):
+                selections[method] = [method(img_binary, fit, margin) for fit in fits]
+            timings[method].append((time.perf_counter() - start) / repeats)
+
+        reference, selection = selections.values()
+        if not all(np.array_equal(a, b) for ref, sel in zip(reference, selection) for a, b in zip(ref, sel)):
+            mismatches += 1
+
+    reference_ms, band_ms = [1000 * np.mean(timing) for timing in timings.values()]
+
+    print('previous fits: nonzero scan %.2f ms/frame, row bands %.2f ms/frame (%.1fx), %i mismatching frames'
+          % (reference_ms, band_ms, reference_ms / band_ms, mismatches))
+
+    return reference_ms, band_ms, mismatches
+
+
+def main():
+    video_file = sys.argv[1] if len(sys.argv) > 1 else 'footage/7_edit.avi'
+
+    print('### processing scale ###')
+    benchmark_processing_scale(video_file)
+
+    print('### previous fits search ###')
+    benchmark_previous_fits(video_file)
+
+
+if __name__ == '__main__':
+    main()
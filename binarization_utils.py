@@ -1,13 +1,140 @@
 import cv2
 import numpy as np
 import glob
+import os
+from functools import lru_cache
 import matplotlib.pyplot as plt
+import cache_utils
+from morphology_utils import MorphologyPlan
+import visualization
 
 
 # selected threshold to highlight yellow lines
 yellow_HSV_th_min = np.array([0, 70, 70])
 yellow_HSV_th_max = np.array([50, 255, 255])
 
+# selected threshold to highlight orange cones
+orange_HSV_th_min = np.array([0, 220, 231])
+orange_HSV_th_max = np.array([47, 255, 359])
+
+# light morphology applied to "fill the gaps" in the binary image
+kernel = np.ones((5, 5), np.uint8)
+kernel3 = np.ones((3, 3), np.uint8)
+lane_morphology = MorphologyPlan([
+    ('open', kernel, 1),
+    ('erode', kernel, 1),
+    ('erode', kernel3, 1),
+    ('close', kernel, 1),
+    ('dilate', kernel3, 5),
+    ('close', kernel, 1),
+    ('close', kernel3, 1),
+])
+
+# number of bits kept per BGR channel by the colour lookup table
+color_lut_bits = 6
+color_lut_cache_dir = './cache'
+
+
+class ColorLUT:
+    """
+    Lookup table classifying BGR pixels against a set of HSV ranges.
+
+    Every quantized BGR colour is converted to HSV and tested against the ranges once,
+    so classifying a frame is a single table lookup with no colour conversion.
+    """
+    def __init__(self, hsv_ranges, bits=color_lut_bits, cache_dir=color_lut_cache_dir):
+        self.bits = bits
+        self.table = self.load_table(hsv_ranges, bits, cache_dir)
+
+        # drops the low bits of every channel value
+        self.quantize = (np.arange(256) >> (8 - bits)).astype(np.uint8)
+
+        # per frame buffers, reused as long as the frame size does not change
+        self._quantized = None
+        self._packed = None
+
+    @staticmethod
+    def pack(b, g, r):
+        # table index of a quantized colour, matches a little-endian uint32 read of (b, g, r, 0)
+        return (r.astype(np.uint32) << 16) | (g.astype(np.uint32) << 8) | b.astype(np.uint32)
+
+    @classmethod
+    def build_table(cls, hsv_ranges, bits):
+        """
+        Classify the centre colour of every quantization bin.
+
+        :param hsv_ranges: list of (min, max) HSV thresholds
+        :param bits: bits kept per channel
+        :return: flat uint8 table, 255 where the colour falls in any of the ranges
+        """
+        step = 1 << (8 - bits)
+        levels = np.arange(1 << bits)
+        centers = np.minimum(levels * step + step // 2, 255).astype(np.uint8)
+
+        b, g, r = [channel.ravel() for channel in np.meshgrid(centers, centers, centers, indexing='ij')]
+        hsv = cv2.cvtColor(np.stack([b, g, r], axis=1).reshape(-1, 1, 3), cv2.COLOR_BGR2HSV)
+
+        in_range = np.zeros(len(hsv), dtype=np.uint8)
+        for min_values, max_values in hsv_ranges:
+            cv2.bitwise_or(in_range, cv2.inRange(hsv, min_values, max_values).ravel(), dst=in_range)
+
+        qb, qg, qr = [channel.ravel() for channel in np.meshgrid(levels, levels, levels, indexing='ij')]
+        index = cls.pack(qb, qg, qr)
+
+        table = np.zeros(int(index.max()) + 1, dtype=np.uint8)
+        table[index] = in_range
+
+        return table
+
+    @classmethod
+    def load_table(cls, hsv_ranges, bits, cache_dir):
+        """
+        Load the table from the disk cache, building (and caching) it if needed.
+        """
+        key = cache_utils.hash_arrays(cv2.__version__, bits, *[bound for hsv_range in hsv_ranges for bound in hsv_range])
+        cache_file = os.path.join(cache_dir, 'color_lut_%s.npz' % key)
+
+        if os.path.isfile(cache_file):
+            return cache_utils.load_npz(cache_file)['table']
+
+        table = cls.build_table(hsv_ranges, bits)
+
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        cache_utils.save_npz(cache_file, table=table)
+
+        return table
+
+    def classify(self, frame, out=None):
+        """
+        Classify every pixel of a BGR frame.
+
+        :param frame: input color frame
+        :param out: optional uint8 output mask
+        :return: uint8 mask, 255 where the pixel colour falls in one of the ranges
+        """
+        h, w = frame.shape[:2]
+
+        if self._packed is None or self._packed.shape[:2] != (h, w):
+            self._quantized = np.empty((h, w, 3), dtype=np.uint8)
+            # the 4th byte stays zero, so each pixel reads as a single table index
+            self._packed = np.zeros((h, w, 4), dtype=np.uint8)
+
+        cv2.LUT(frame, self.quantize, dst=self._quantized)
+        cv2.mixChannels([self._quantized], [self._packed], [0, 0, 1, 1, 2, 2])
+        index = self._packed.view('<u4')[..., 0]
+
+        return np.take(self.table, index, out=out)
+
+
+@lru_cache(maxsize=None)
+def get_lane_color_lut():
+    """
+    Lookup table highlighting yellow lines and orange cones, built on first use.
+    """
+    return ColorLUT([(yellow_HSV_th_min, yellow_HSV_th_max),
+                     (orange_HSV_th_min, orange_HSV_th_max)])
+
 
 def thresh_frame_in_HSV(frame, min_values, max_values, verbose=False):
     """
@@ -66,55 +193,99 @@ def get_binary_from_equalized_grayscale(frame):
     return th
 
 
-def binarize(img, verbose=False):
+@lru_cache(maxsize=None)
+def get_lane_morphology(scale=1.0):
     """
-    Convert an input frame to a binary image which highlight as most as possible the lane-lines.
+    Lane morphology with kernels resized for the given processing scale.
+    """
+    if scale == 1.0:
+        return lane_morphology
+    return lane_morphology.scaled(scale)
 
-    :param img: input color frame
-    :param verbose: if True, show intermediate results
-    :return: binarized frame
+
+def downscale(img, scale):
     """
+    Resize a frame to the processing scale.
+
+    Scales that are a power of two (0.5, 0.25, ...) go through cv2.pyrDown, other scales through cv2.resize.
+
+    :param img: input frame
+    :param scale: processing scale relative to the input frame
+    :return: resized frame
+    """
+    if scale == 1.0:
+        return img
+
+    levels = -np.log2(scale)
+    if levels > 0 and levels == int(levels):
+        for _ in range(int(levels)):
+            img = cv2.pyrDown(img)
+        return img
+
     h, w = img.shape[:2]
+    return cv2.resize(img, (int(round(w * scale)), int(round(h * scale))), interpolation=cv2.INTER_AREA)
 
-    binary = np.zeros(shape=(h, w), dtype=np.uint8)
 
-    blurred = cv2.GaussianBlur(img, (5, 5), 0)
-    blurred = cv2.GaussianBlur(img, (5, 5), 0)
-    blurred = cv2.GaussianBlur(img, (5, 5), 0)
+def upscale(mask, shape):
+    """
+    Map a mask computed at the processing scale back to the input resolution.
 
-    cv2.imshow('blurred', blurred)
+    :param mask: binary mask at the processing scale
+    :param shape: shape of the input frame
+    :return: mask of the input frame size, values are kept as they are (nearest neighbour)
+    """
+    h, w = shape[:2]
+    if mask.shape[:2] == (h, w):
+        return mask
+
+    return cv2.resize(mask, (w, h), interpolation=cv2.INTER_NEAREST)
 
-    # highlight yellow lines by threshold in HSV color space
-    HSV_yellow_mask = thresh_frame_in_HSV(blurred, yellow_HSV_th_min, yellow_HSV_th_max, verbose=False)
-    binary = np.logical_or(binary, HSV_yellow_mask)
 
-    # highlight orange cones
-    orange_HSV_th_min = np.array([0, 220, 231])
-    orange_HSV_th_max = np.array([47, 255, 359])
-    HSV_orange_mask = thresh_frame_in_HSV(blurred, orange_HSV_th_min, orange_HSV_th_max, verbose=False)
-    binary = np.logical_or(binary, HSV_orange_mask)
+def get_lane_mask(blurred):
+    """
+    Highlight lane-lines and cones in a (blurred) color frame, before morphology.
+
+    :param blurred: input color frame
+    :return: combined binary mask, and the white lines mask alone
+    """
+    # highlight yellow lines and orange cones with a single lookup in the precomputed colour table
+    binary = get_lane_color_lut().classify(blurred)
 
     # highlight white lines by thresholding the equalized frame
+    # (equalization depends on the whole frame histogram, so it cannot be part of the table)
     eq_white_mask = get_binary_from_equalized_grayscale(blurred)
-    binary = np.logical_or(binary, eq_white_mask)
+    cv2.bitwise_or(binary, eq_white_mask, dst=binary)
+
+    return binary, eq_white_mask
+
+
+def binarize(img, verbose=False, scale=1.0, full_resolution=True):
+    """
+    Convert an input frame to a binary image which highlight as most as possible the lane-lines.
+
+    :param img: input color frame
+    :param verbose: if True, show intermediate results
+    :param scale: processing scale relative to the input frame, see downscale()
+    :param full_resolution: if True, the mask is mapped back to the input frame size (see upscale()),
+                            otherwise it is returned at the processing scale, e.g. for the lane search
+    :return: binarized frame
+    """
+    input_shape = img.shape
+    img = downscale(img, scale)
+
+    blurred = cv2.GaussianBlur(img, (5, 5), 0)
+
+    visualization.publish('blurred', blurred)
+
+    binary, eq_white_mask = get_lane_mask(blurred)
 
     # get Sobel binary mask (thresholded gradients)
     #sobel_mask = thresh_frame_sobel(blurred, kernel_size=9)
     #binary = np.logical_or(binary, sobel_mask)
 
     # apply a light morphology to "fill the gaps" in the binary image
-    kernel = np.ones((5, 5), np.uint8)
-    kernel3 = np.ones((3, 3), np.uint8)
-    kernel1 = np.array(([0,0,0],[1,1,1],[0,0,0]),dtype=np.uint8)
-    closing = cv2.morphologyEx(binary.astype(np.uint8), cv2.MORPH_OPEN, kernel)
-    closing = cv2.erode(closing, kernel, iterations=1)
-    closing = cv2.erode(closing, kernel3, iterations=1)
-    closing = cv2.morphologyEx(closing, cv2.MORPH_CLOSE, kernel)
-    closing = cv2.dilate(closing, kernel3, iterations=5)
-    closing = cv2.morphologyEx(closing, cv2.MORPH_CLOSE, kernel)
-    closing = cv2.morphologyEx(closing, cv2.MORPH_CLOSE, kernel3)
-
-
+    # (compiled chain, see lane_morphology; verify_morphology checks it against the original one)
+    closing = get_lane_morphology(scale).apply(binary)
 
     if verbose:
         f, ax = plt.subplots(2, 3)
@@ -127,8 +298,8 @@ def binarize(img, verbose=False):
         ax[0, 1].set_title('white mask')
         ax[0, 1].set_axis_off()
 
-        ax[0, 2].imshow(HSV_yellow_mask, cmap='gray')
-        ax[0, 2].set_title('yellow mask')
+        ax[0, 2].imshow(get_lane_color_lut().classify(blurred), cmap='gray')
+        ax[0, 2].set_title('yellow / orange mask')
         ax[0, 2].set_axis_off()
 
         ax[1, 0].imshow(sobel_mask, cmap='gray')
@@ -144,11 +315,43 @@ def binarize(img, verbose=False):
         ax[1, 2].set_axis_off()
         plt.show()
 
-    closing = np.array(closing * 255, dtype = np.uint8)
+    if full_resolution:
+        return upscale(closing, input_shape)
 
     return closing
 
 
+def verify_morphology(video_file, max_frames=None):
+    """
+    Check on recorded footage that the compiled lane morphology matches the original chain.
+
+    :param video_file: recorded footage
+    :param max_frames: maximum number of frames to check
+    :return: number of frames checked and number of pixels that differ in total
+    """
+    def lane_masks():
+        cap = cv2.VideoCapture(video_file)
+        num_frames = 0
+
+        while cap.isOpened() and (max_frames is None or num_frames < max_frames):
+            ret, frame = cap.read()
+            if not ret:
+                break
+
+            blurred = cv2.GaussianBlur(frame, (5, 5), 0)
+            binary, _ = get_lane_mask(blurred)
+            num_frames += 1
+
+            yield binary
+
+        cap.release()
+
+    num_frames, num_different = lane_morphology.verify(lane_masks())
+    print('%s: %i frames, %i different pixels' % (video_file, num_frames, num_different))
+
+    return num_frames, num_different
+
+
 if __name__ == '__main__':
     '''
     test_images = glob.glob('test_images/*.jpg')
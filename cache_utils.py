@@ -0,0 +1,98 @@
+'''
+Helpers for on-disk numeric caches
+
+Caches are stored as uncompressed .npz archives so they can be memory-mapped
+on load instead of being copied into memory.
+'''
+
+import hashlib
+import os
+import zipfile
+
+import numpy as np
+
+# size of the fixed part of a zip local file header
+ZIP_LOCAL_HEADER_SIZE = 30
+
+
+def hash_arrays(*items):
+    """
+    Compute a stable hex digest for a sequence of arrays and plain python values.
+
+    :param items: arrays, lists, tuples, numbers or strings
+    :return: hex digest string
+    """
+    digest = hashlib.sha1()
+
+    for item in items:
+        array = np.asarray(item)
+        if array.dtype.hasobject:
+            digest.update(repr(item).encode('utf-8'))
+        else:
+            digest.update(str(array.dtype).encode('ascii'))
+            digest.update(str(array.shape).encode('ascii'))
+            digest.update(np.ascontiguousarray(array).tobytes())
+        digest.update(b'|')
+
+    return digest.hexdigest()
+
+
+def save_npz(file_path, **arrays):
+    """
+    Atomically write arrays to an uncompressed .npz archive.
+
+    :param file_path: destination path
+    :param arrays: named arrays to store
+    :return: None
+    """
+    tmp_path = file_path + '.tmp'
+    with open(tmp_path, 'wb') as file:
+        np.savez(file, **arrays)
+    os.replace(tmp_path, file_path)
+
+
+def load_npz(file_path, mmap=True):
+    """
+    Load all arrays from an .npz archive.
+
+    Uncompressed members are memory-mapped read-only when mmap is True, so no data
+    is copied until it is actually used. Compressed members are read normally.
+
+    :param file_path: path of the .npz archive
+    :param mmap: if True, memory-map uncompressed members
+    :return: dict of name -> array
+    """
+    arrays = {}
+
+    with zipfile.ZipFile(file_path) as archive, open(file_path, 'rb') as file:
+        for info in archive.infolist():
+            name = info.filename[:-len('.npy')] if info.filename.endswith('.npy') else info.filename
+
+            if not mmap or info.compress_type != zipfile.ZIP_STORED:
+                with archive.open(info) as member:
+                    arrays[name] = np.lib.format.read_array(member, allow_pickle=False)
+                continue
+
+            # skip the local file header to reach the raw .npy member
+            file.seek(info.header_offset)
+            header = file.read(ZIP_LOCAL_HEADER_SIZE)
+            name_length = int.from_bytes(header[26:28], 'little')
+            extra_length = int.from_bytes(header[28:30], 'little')
+            file.seek(info.header_offset + ZIP_LOCAL_HEADER_SIZE + name_length + extra_length)
+
+            version = np.lib.format.read_magic(file)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(file)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(file)
+
+            if dtype.hasobject:
+                raise ValueError('Refusing to load object array "%s" from %s' % (name, file_path))
+
+            if int(np.prod(shape)) == 0:
+                arrays[name] = np.empty(shape, dtype=dtype)
+            else:
+                arrays[name] = np.memmap(file_path, dtype=dtype, mode='r', offset=file.tell(), shape=shape,
+                                         order='F' if fortran_order else 'C')
+
+    return arrays
@@ -9,18 +9,46 @@ assert cv2.__version__[0] == '3', 'The fisheye module requires opencv version >=
 import numpy as np
 import os
 import glob
+import time
+import logging
+
+import cache_utils
+import chessboard_utils
+from homography_utils import get_perspective_transforms
 
 class CameraCalibration:
+    # version of the binary profile format written by export_data
+    PROFILE_VERSION = 1
+
     def __init__(self, profile=None):
         self.CHECKERBOARD = (4,5)
 
         self.PATH_CHESSBOARD = './chessboard'
         self.PATH_VERIFICATION = './verification'
+        self.PATH_CACHE = './cache'
+        self.PATH_PROFILES = './profiles'
+        # map coordinate used for pixels that fall outside the camera frame
+        self.OFF_IMAGE = 10000
         # self.MIN_SAMPLES = 200
         self.MIN_SAMPLES = 4
 
+        self._maps = {}
         self.profile = profile
 
+        # calibration quality and time, known after calibrate() or import_data()
+        self.rms = None
+        self.timestamp = None
+
+    @property
+    def profile(self):
+        return self._profile
+
+    @profile.setter
+    def profile(self, profile):
+        # maps built for a previous profile are no longer valid
+        self._profile = profile
+        self._maps = {}
+
     def calibrate(self):
         self.make_directory(self.PATH_CHESSBOARD)
         self.make_directory(self.PATH_VERIFICATION)
@@ -45,8 +73,8 @@ class CameraCalibration:
         cv2.destroyAllWindows()
 
     def calibrator(self):
-        subpix_criteria = (cv2.TERM_CRITERIA_EPS+cv2.TERM_CRITERIA_MAX_ITER, 30, 0.1)
         calibration_flags = cv2.fisheye.CALIB_RECOMPUTE_EXTRINSIC+cv2.fisheye.CALIB_CHECK_COND+cv2.fisheye.CALIB_FIX_SKEW
+        detection_flags = cv2.CALIB_CB_ADAPTIVE_THRESH+cv2.CALIB_CB_FAST_CHECK+cv2.CALIB_CB_NORMALIZE_IMAGE
 
         objp = np.zeros((1, self.CHECKERBOARD[0]*self.CHECKERBOARD[1], 3), np.float32)
         objp[0,:,:2] = np.mgrid[0:self.CHECKERBOARD[0], 0:self.CHECKERBOARD[1]].T.reshape(-1, 2)
@@ -57,28 +85,26 @@ class CameraCalibration:
 
         images = glob.glob(self.PATH_CHESSBOARD + '/*.jpg')
 
-        for fname in images:
-            img = cv2.imread(fname)
+        # corners are detected in parallel and cached per image, only new images are processed
+        # (and get a verification image written)
+        detections = chessboard_utils.find_chessboard_corners(
+            images,
+            self.CHECKERBOARD,
+            detection_flags,
+            verification_dir=self.PATH_VERIFICATION,
+            cache_dir=os.path.join(self.PATH_CACHE, 'chessboard')
+        )
+
+        for fname, ret, corners, shape in detections:
             if _img_shape == None:
-                _img_shape = img.shape[:2]
+                _img_shape = shape[:2]
             else:
-                assert _img_shape == img.shape[:2], "All images must share the same size."
+                assert _img_shape == shape[:2], "All images must share the same size."
 
-            gray = cv2.cvtColor(img,cv2.COLOR_BGR2GRAY)
-            # Find the chess board corners
-            ret, corners = cv2.findChessboardCorners(gray, self.CHECKERBOARD, cv2.CALIB_CB_ADAPTIVE_THRESH+cv2.CALIB_CB_FAST_CHECK+cv2.CALIB_CB_NORMALIZE_IMAGE)
-            # If found, add object points, image points (after refining them)
             if ret == True:
                 objpoints.append(objp)
-                cv2.cornerSubPix(gray,corners,(3,3),(-1,-1),subpix_criteria)
                 imgpoints.append(corners)
 
-                cv2.drawChessboardCorners(img, self.CHECKERBOARD, corners,ret)
-                # cv2.imshow('img',img)
-                # cv2.imwrite(self.PATH_VERIFICATION + '/%s.jpg' % fname, img)
-                filename = fname[len(self.PATH_CHESSBOARD) + 1:]
-                cv2.imwrite(self.PATH_VERIFICATION + '/%s.jpg' % filename, img)
-
         N_OK = len(objpoints)
         K = np.zeros((3, 3))
         D = np.zeros((4, 1))
@@ -88,7 +114,7 @@ class CameraCalibration:
             cv2.fisheye.calibrate(
                 objpoints,
                 imgpoints,
-                gray.shape[::-1],
+                _img_shape[::-1],
                 K,
                 D,
                 rvecs,
@@ -97,30 +123,195 @@ class CameraCalibration:
                 (cv2.TERM_CRITERIA_EPS+cv2.TERM_CRITERIA_MAX_ITER, 30, 1e-6)
             )
 
+        self.rms = rms
+        self.timestamp = time.time()
+
         profile = (_img_shape[::-1], K.tolist(), D.tolist())
         return profile
 
-    def undistort(self, img):
+    def get_undistort_maps(self, frame_size):
+        '''
+        Return the fisheye undistortion maps for the current profile and frame size.
+
+        The maps are built once per (profile, frame size), saved to PATH_CACHE as
+        .npz and memory-mapped when they are needed again, including on later runs.
+        '''
+        def build_maps():
+            DIM, K, D = self.get_profile_arrays()
+            return cv2.fisheye.initUndistortRectifyMap(K, D, np.eye(3), K, DIM, cv2.CV_16SC2)
+
+        return self.get_cached_maps('undistort', build_maps, frame_size)
+
+    def get_birds_eye_maps(self, frame_size, src_pts, dst_pts):
+        '''
+        Return remap tables going straight from raw camera pixels to the bird's eye view.
+
+        The fisheye undistortion map is composed with the inverse ROI homography, so
+        a single cv2.remap replaces undistort() followed by cv2.warpPerspective.
+        '''
+        def build_maps():
+            DIM, K, D = self.get_profile_arrays()
+            map_x, map_y = cv2.fisheye.initUndistortRectifyMap(K, D, np.eye(3), K, DIM, cv2.CV_32FC1)
+
+            w, h = frame_size
+            _, Minv = get_perspective_transforms((h, w), src_pts, dst_pts)
+
+            # position of every bird's eye pixel in the undistorted frame
+            grid = np.mgrid[0:h, 0:w][::-1].transpose(1, 2, 0).reshape(-1, 1, 2).astype(np.float32)
+            undistorted_pts = cv2.perspectiveTransform(grid, Minv).reshape(h, w, 2)
+
+            # look up the raw pixel each undistorted position comes from
+            fused_x = cv2.remap(map_x, undistorted_pts[..., 0], undistorted_pts[..., 1], interpolation=cv2.INTER_LINEAR,
+                                borderMode=cv2.BORDER_REPLICATE)
+            fused_y = cv2.remap(map_y, undistorted_pts[..., 0], undistorted_pts[..., 1], interpolation=cv2.INTER_LINEAR,
+                                borderMode=cv2.BORDER_REPLICATE)
+
+            # undistorted pixels that come from outside the raw frame are black
+            raw_w, raw_h = DIM
+            undistorted_valid = ((map_x >= 0) & (map_x <= raw_w - 1) & (map_y >= 0) & (map_y <= raw_h - 1))
+
+            # points whose interpolation touched a black undistorted pixel or the outside of the
+            # undistorted frame would mix real coordinates with invalid ones and sample unrelated
+            # raw pixels, they are sent off-image so they stay black
+            valid = cv2.remap(undistorted_valid.astype(np.float32), undistorted_pts[..., 0], undistorted_pts[..., 1],
+                              interpolation=cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+            off_image = valid < 1
+            fused_x[off_image] = -self.OFF_IMAGE
+            fused_y[off_image] = -self.OFF_IMAGE
+
+            return cv2.convertMaps(fused_x, fused_y, cv2.CV_16SC2)
+
+        return self.get_cached_maps('birdseye', build_maps, frame_size, np.float32(src_pts), np.float32(dst_pts))
+
+    def get_cached_maps(self, name, build_maps, *key_items):
+        '''
+        Look up a pair of remap tables in memory, then on disk, and build them as a last resort.
+        '''
+        key = self.get_map_key(name, *key_items)
+        maps = self._maps.get(key)
+
+        if maps is None:
+            cache_file = os.path.join(self.PATH_CACHE, '%s_%s.npz' % (name, key))
+
+            if os.path.isfile(cache_file):
+                data = cache_utils.load_npz(cache_file)
+                maps = (data['map1'], data['map2'])
+            else:
+                map1, map2 = build_maps()
+
+                self.make_directory(self.PATH_CACHE)
+                cache_utils.save_npz(cache_file, map1=map1, map2=map2)
+                maps = (map1, map2)
+
+            self._maps[key] = maps
+
+        return maps
+
+    def get_map_key(self, name, *key_items):
         assert self.profile != None
         profile = self.profile
+        return cache_utils.hash_arrays(name, profile[0], profile[1], profile[2], *key_items)
 
-        DIM = profile[0]
-        K=np.array(profile[1])
-        D=np.array(profile[2])
+    def get_profile_arrays(self):
+        DIM = tuple(self.profile[0])
+        K = np.array(self.profile[1])
+        D = np.array(self.profile[2])
+        return DIM, K, D
 
+    def undistort(self, img):
         h,w = img.shape[:2]
 
-        map1, map2 = cv2.fisheye.initUndistortRectifyMap(K, D, np.eye(3), K, DIM, cv2.CV_16SC2)
+        map1, map2 = self.get_undistort_maps((w, h))
         undistorted_img = cv2.remap(img, map1, map2, interpolation=cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT)
         return undistorted_img
 
-    def import_data(self):
-        raise NotImplementedError
+    def undistort_birds_eye(self, img, src_pts, dst_pts):
+        '''
+        Undistort a raw frame and warp it to the bird's eye view with a single remap.
+
+        Equivalent to warping undistort(img) with the (src_pts -> dst_pts) homography,
+        without the full-frame undistorted intermediate.
+        '''
+        h,w = img.shape[:2]
+
+        map1, map2 = self.get_birds_eye_maps((w, h), src_pts, dst_pts)
+        birds_eye_img = cv2.remap(img, map1, map2, interpolation=cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT)
+        return birds_eye_img
+
+    def get_profile_path(self, camera_id=0):
+        return os.path.join(self.PATH_PROFILES, 'camera_%s.npz' % camera_id)
+
+    def import_data(self, path=None, camera_id=0):
+        '''
+        Load a binary profile written by export_data.
+
+        The undistortion maps stored with the profile are memory-mapped and used
+        directly by undistort(), so nothing has to be recomputed at startup.
+        '''
+        if path is None:
+            path = self.get_profile_path(camera_id)
+
+        data = cache_utils.load_npz(path)
 
-    def export_data(self):
-        profile = tuple(str(result) for result in self.profile)
-        with open('profile.txt', 'w') as file:
-            file.write('%s\n%s\n%s' % ('DIM = ' + profile[0], 'K = np.array(%s)' % profile[1], 'D = np.array(%s)' % profile[2]))
+        version = int(data['version'])
+        if version != self.PROFILE_VERSION:
+            raise ValueError('Unsupported profile version %i in %s (expected %i)' % (version, path, self.PROFILE_VERSION))
+
+        DIM = tuple(int(v) for v in data['DIM'])
+        self.profile = (DIM, np.array(data['K']), np.array(data['D']))
+        self.rms = float(data['rms'])
+        self.timestamp = float(data['timestamp'])
+
+        self._maps[self.get_map_key('undistort', DIM)] = (data['map1'], data['map2'])
+
+    def export_data(self, path=None, camera_id=0):
+        '''
+        Save the current profile, with its precomputed undistortion maps, as a binary .npz profile.
+        '''
+        assert self.profile != None
+
+        if path is None:
+            self.make_directory(self.PATH_PROFILES)
+            path = self.get_profile_path(camera_id)
+
+        DIM, K, D = self.get_profile_arrays()
+        map1, map2 = self.get_undistort_maps(DIM)
+
+        cache_utils.save_npz(
+            path,
+            version=self.PROFILE_VERSION,
+            camera_id=str(camera_id),
+            DIM=np.array(DIM),
+            K=K,
+            D=D,
+            rms=np.nan if self.rms is None else self.rms,
+            timestamp=time.time() if self.timestamp is None else self.timestamp,
+            map1=map1,
+            map2=map2
+        )
+
+    @classmethod
+    def from_camera_id(cls, camera_id=0, fallback_profile=None):
+        '''
+        Create a CameraCalibration from the stored profile of a camera.
+
+        A missing profile raises FileNotFoundError (export it with python calibration.py),
+        unless a fallback_profile calibrated for this same camera is given, which is then
+        used with a warning.
+        '''
+        CC = cls()
+        path = CC.get_profile_path(camera_id)
+
+        if os.path.isfile(path):
+            CC.import_data(path)
+        elif fallback_profile is not None:
+            logging.warning('No calibration profile at %s, using the given fallback profile '
+                            '(run python calibration.py to export it)' % path)
+            CC.profile = fallback_profile
+        else:
+            raise FileNotFoundError('No calibration profile at %s, run python calibration.py to export it' % path)
+
+        return CC
 
     @staticmethod
     def make_directory(path):
@@ -128,16 +319,20 @@ class CameraCalibration:
             os.mkdir(path)
 
 def main():
+    # calibration of the car camera, exported as the profile of camera 0
     DIM = (640, 480)
     K = np.array([[359.0717640266508, 0.0, 315.08914578097387], [0.0, 358.06497428501837, 240.75242680088732], [0.0, 0.0, 1.0]])
     D = np.array([[-0.041705903204711826], [0.3677107787593379], [-1.4047363783373128], [1.578157237454529]])
     profile = (DIM, K, D)
     CC = CameraCalibration(profile)
+    CC.export_data(camera_id=0)
 
     # CC = CameraCalibration()
     # CC.calibrate()
-    # CC.export_data()
+    # CC.export_data(camera_id=0)
     # CC.demo()
 
+    # CC = CameraCalibration.from_camera_id(0)
+
 if __name__ == "__main__":
     main()
@@ -1,33 +1,82 @@
 import cv2
 import numpy as np
 import glob
+import inspect
+import os
 import matplotlib.pyplot as plt
 import os.path as path
-import pickle
+import cache_utils
+from chessboard_utils import find_chessboard_corners, hash_file
+
+# chessboard inner corners (columns, rows) and file pattern of the calibration images
+calibration_pattern_size = (9, 6)
+calibration_images = 'calibration*.jpg'
+
+# cached calibrations are stored here, only the most recently used ones are kept
+calibration_cache_dir = 'camera_cal/cache'
+calibration_cache_size = 4
 
 
 def lazy_calibration(func):
     """
     Decorator for calibration function to avoid re-computing calibration every time.
+
+    Results are cached under a hash of the calibration images content, the chessboard pattern
+    and the function arguments, so adding or changing images triggers a new calibration.
+    Entries are stored as .npz files (no pickle) and memory-mapped on load; the least recently
+    used entries are evicted once there are more than calibration_cache_size of them.
     """
-    calibration_cache = 'camera_cal/calibration_data.pickle'
+    signature = inspect.signature(func)
 
     def wrapper(*args, **kwargs):
-        if path.exists(calibration_cache):
+        arguments = signature.bind(*args, **kwargs)
+        arguments.apply_defaults()
+
+        # verbose only changes what is displayed, not the result
+        key_arguments = sorted((name, value) for name, value in arguments.arguments.items() if name != 'verbose')
+
+        images = glob.glob(path.join(arguments.arguments['calib_images_dir'], calibration_images))
+        image_hashes = sorted(hash_file(image) for image in images)
+
+        key = cache_utils.hash_arrays(func.__name__, calibration_pattern_size, repr(key_arguments), image_hashes)
+        cache_file = path.join(calibration_cache_dir, '%s.npz' % key)
+
+        if path.exists(cache_file):
             print('Loading cached camera calibration...', end=' ')
-            with open(calibration_cache, 'rb') as dump_file:
-                calibration = pickle.load(dump_file)
+            data = cache_utils.load_npz(cache_file)
+            calibration = (float(data['ret']), data['mtx'], data['dist'], list(data['rvecs']), list(data['tvecs']))
+            # mark the entry as recently used
+            os.utime(cache_file)
         else:
             print('Computing camera calibration...', end=' ')
             calibration = func(*args, **kwargs)
-            with open(calibration_cache, 'wb') as dump_file:
-                pickle.dump(calibration, dump_file)
+            ret, mtx, dist, rvecs, tvecs = calibration
+
+            if not path.isdir(calibration_cache_dir):
+                os.makedirs(calibration_cache_dir)
+            cache_utils.save_npz(cache_file, ret=ret, mtx=mtx, dist=dist, rvecs=np.array(rvecs), tvecs=np.array(tvecs))
+            evict_calibrations(calibration_cache_dir, calibration_cache_size)
         print('Done.')
         return calibration
 
     return wrapper
 
 
+def evict_calibrations(cache_dir, max_entries):
+    """
+    Remove the least recently used cached calibrations beyond max_entries.
+
+    :param cache_dir: directory containing the cached calibrations
+    :param max_entries: number of entries to keep
+    :return: None
+    """
+    entries = glob.glob(path.join(cache_dir, '*.npz'))
+    entries.sort(key=path.getmtime, reverse=True)
+
+    for entry in entries[max_entries:]:
+        os.remove(entry)
+
+
 @lazy_calibration
 def calibrate_camera(calib_images_dir, verbose=False):
     """
@@ -41,24 +90,21 @@ def calibrate_camera(calib_images_dir, verbose=False):
     assert path.exists(calib_images_dir), '"{}" must exist and contain calibration images.'.format(calib_images_dir)
 
     # prepare object points, like (0,0,0), (1,0,0), (2,0,0) ....,(6,5,0)
-    objp = np.zeros((6 * 9, 3), np.float32)
-    objp[:, :2] = np.mgrid[0:9, 0:6].T.reshape(-1, 2)
+    cols, rows = calibration_pattern_size
+    objp = np.zeros((rows * cols, 3), np.float32)
+    objp[:, :2] = np.mgrid[0:cols, 0:rows].T.reshape(-1, 2)
 
     # Arrays to store object points and image points from all the images.
     objpoints = []  # 3d points in real world space
     imgpoints = []  # 2d points in image plane.
 
     # Make a list of calibration images
-    images = glob.glob(path.join(calib_images_dir, 'calibration*.jpg'))
-
-    # Step through the list and search for chessboard corners
-    for filename in images:
+    images = glob.glob(path.join(calib_images_dir, calibration_images))
 
-        img = cv2.imread(filename)
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    # Search for chessboard corners (in parallel, only images not seen before are processed)
+    detections = find_chessboard_corners(images, calibration_pattern_size)
 
-        # Find the chessboard corners
-        pattern_found, corners = cv2.findChessboardCorners(gray, (9, 6), None)
+    for filename, pattern_found, corners, shape in detections:
 
         if pattern_found is True:
             objpoints.append(objp)
@@ -66,14 +112,15 @@ def calibrate_camera(calib_images_dir, verbose=False):
 
             if verbose:
                 # Draw and display the corners
-                img = cv2.drawChessboardCorners(img, (9, 6), corners, pattern_found)
+                img = cv2.imread(filename)
+                img = cv2.drawChessboardCorners(img, calibration_pattern_size, corners, pattern_found)
                 cv2.imshow('img',img)
                 cv2.waitKey(500)
 
     if verbose:
         cv2.destroyAllWindows()
 
-    ret, mtx, dist, rvecs, tvecs = cv2.calibrateCamera(objpoints, imgpoints, gray.shape[::-1], None, None)
+    ret, mtx, dist, rvecs, tvecs = cv2.calibrateCamera(objpoints, imgpoints, shape[::-1], None, None)
 
     return ret, mtx, dist, rvecs, tvecs
 
@@ -0,0 +1,132 @@
+'''
+Chessboard corner detection shared by the calibration routines
+
+Corners are searched for on a downscaled pyramid level, then refined with
+cornerSubPix at full resolution. Images are processed on a process pool and
+every result is cached under a hash of the image content, so re-running a
+calibration only processes the images that were added or changed.
+'''
+
+import hashlib
+import os
+from multiprocessing import Pool
+
+import cv2
+import numpy as np
+
+import cache_utils
+
+PATH_CACHE = './cache/chessboard'
+
+SUBPIX_CRITERIA = (cv2.TERM_CRITERIA_EPS+cv2.TERM_CRITERIA_MAX_ITER, 30, 0.1)
+
+# images smaller than this (in pixels, shortest side) are never downscaled
+MIN_PYRAMID_SIZE = 240
+
+
+def hash_file(file_path):
+    """
+    Hash the content of a file.
+
+    :param file_path: path of the file
+    :return: hex digest string
+    """
+    digest = hashlib.sha1()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def detect_corners(task):
+    """
+    Find and refine the chessboard corners of a single image.
+
+    :param task: tuple (image path, pattern size, detection flags, pyramid levels, subpix window, verification path)
+    :return: tuple (pattern found, corners, image shape)
+    """
+    file_path, pattern_size, flags, pyramid_levels, subpix_window, verification_path = task
+
+    img = cv2.imread(file_path)
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+
+    # search on a downscaled copy first, it is much cheaper on large frames
+    small = gray
+    levels = 0
+    while levels < pyramid_levels and min(small.shape) // 2 >= MIN_PYRAMID_SIZE:
+        small = cv2.pyrDown(small)
+        levels += 1
+
+    found, corners = cv2.findChessboardCorners(small, pattern_size, flags)
+
+    if found:
+        corners = corners * (2 ** levels)
+    elif levels > 0:
+        found, corners = cv2.findChessboardCorners(gray, pattern_size, flags)
+
+    if found:
+        # the window must cover the position error introduced by the pyramid
+        window = (max(subpix_window[0], 2 ** levels + 1), max(subpix_window[1], 2 ** levels + 1))
+        corners = cv2.cornerSubPix(gray, np.float32(corners).reshape(-1, 1, 2), window, (-1, -1), SUBPIX_CRITERIA)
+
+        if verification_path is not None:
+            cv2.drawChessboardCorners(img, pattern_size, corners, found)
+            cv2.imwrite(verification_path, img)
+    else:
+        corners = np.zeros((0, 1, 2), np.float32)
+
+    return bool(found), corners, gray.shape
+
+
+def find_chessboard_corners(image_paths, pattern_size, flags=None, pyramid_levels=1, subpix_window=(3, 3),
+                            verification_dir=None, processes=None, cache_dir=PATH_CACHE):
+    """
+    Detect chessboard corners in a set of images, reusing cached results when possible.
+
+    :param image_paths: list of image paths
+    :param pattern_size: inner corners per chessboard row and column
+    :param flags: cv2.findChessboardCorners flags
+    :param pyramid_levels: maximum number of pyrDown levels used for the initial search
+    :param subpix_window: half size of the cornerSubPix search window
+    :param verification_dir: if set, newly processed images with drawn corners are written there
+    :param processes: size of the process pool (defaults to the number of CPUs)
+    :param cache_dir: directory holding the per-image cache entries
+    :return: list of (image path, pattern found, corners, image shape), in input order
+    """
+    if flags is None:
+        flags = cv2.CALIB_CB_ADAPTIVE_THRESH + cv2.CALIB_CB_NORMALIZE_IMAGE
+
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    results = {}
+    tasks = []
+    cache_files = {}
+
+    for file_path in image_paths:
+        key = cache_utils.hash_arrays(hash_file(file_path), pattern_size, flags, pyramid_levels, subpix_window)
+        cache_file = os.path.join(cache_dir, '%s.npz' % key)
+
+        if os.path.isfile(cache_file):
+            data = cache_utils.load_npz(cache_file, mmap=False)
+            results[file_path] = (bool(data['found']), data['corners'], tuple(int(v) for v in data['shape']))
+        else:
+            verification_path = None
+            if verification_dir is not None:
+                verification_path = os.path.join(verification_dir, '%s.jpg' % os.path.basename(file_path))
+
+            tasks.append((file_path, pattern_size, flags, pyramid_levels, subpix_window, verification_path))
+            cache_files[file_path] = cache_file
+
+    if len(tasks) > 1:
+        with Pool(processes) as pool:
+            detections = pool.map(detect_corners, tasks)
+    else:
+        detections = [detect_corners(task) for task in tasks]
+
+    for task, (found, corners, shape) in zip(tasks, detections):
+        file_path = task[0]
+        cache_utils.save_npz(cache_files[file_path], found=found, corners=corners, shape=shape)
+        results[file_path] = (found, corners, shape)
+
+    return [(file_path,) + results[file_path] for file_path in image_paths]
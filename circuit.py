@@ -24,9 +24,8 @@ while cap.isOpened():
         turn_angle = pathfinder.compute_turn_angle(grey)
         print('turn angle:', turn_angle)
 
-        turn_angle_message = str('a%d' % int(turn_angle))
-        comm.write_serial_message(turn_angle_message)
-        comm.write_serial_message('s50')
+        comm.set_angle(int(turn_angle))
+        comm.set_speed(50)
 
         cv2.imshow('frame', frame)
 
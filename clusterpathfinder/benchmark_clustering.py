@@ -0,0 +1,106 @@
+'''
+Benchmark of the grid based proximity clustering against the former pairwise implementation
+
+usage: python3 -m clusterpathfinder.benchmark_clustering
+'''
+
+import time
+
+import numpy as np
+
+from clusterpathfinder import pathfinding
+
+SEGMENT_COUNTS = (100, 300, 1000, 3000, 10000)
+
+# the pairwise implementation is only run up to this number of segments
+MAX_PAIRWISE_SEGMENTS = 1000
+
+
+def cluster_by_proximity_pairwise(line_list):
+    """
+    Former implementation: one cluster per seed segment, holding every segment linked to it
+    (drawing left out)
+    """
+    clusters = []
+
+    for line in line_list:
+        clusters.append([line])
+        for query_line in line_list:
+            distance = pathfinding.compute_point_distance(line.midpoint, query_line.midpoint)
+            if distance <= 100 and abs(line.angle - query_line.angle) < 10:
+                clusters[-1].append(query_line)
+
+    return clusters
+
+
+def get_components(line_list, clusters):
+    """
+    Connected components of the links found by the pairwise implementation, as a set of frozensets of indices
+    """
+    index = {id(line): i for i, line in enumerate(line_list)}
+    parent = list(range(len(line_list)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for cluster in clusters:
+        seed = find(index[id(cluster[0])])
+        for line in cluster[1:]:
+            parent[find(index[id(line)])] = seed
+            seed = find(seed)
+
+    components = {}
+    for i in range(len(line_list)):
+        components.setdefault(find(i), set()).add(i)
+
+    return {frozenset(component) for component in components.values()}
+
+
+def get_label_components(labels):
+    return {frozenset(np.flatnonzero(labels == label)) for label in np.unique(labels)}
+
+
+def generate_segments(count, width=640, height=480, seed=0):
+    """
+    Random short segments, grouped around a few lane-like lines plus clutter
+    """
+    rng = np.random.default_rng(seed)
+
+    centers = np.column_stack((rng.uniform(0, width, count), rng.uniform(0, height, count)))
+    angles = np.where(rng.random(count) < 0.7, rng.normal(np.pi / 2, 0.1, count), rng.uniform(0, np.pi, count))
+    lengths = rng.uniform(5, 40, count)
+
+    offsets = np.column_stack((np.cos(angles), np.sin(angles))) * lengths[:, None] / 2
+    segments = np.hstack((centers - offsets, centers + offsets))
+
+    return np.int32(np.round(segments))
+
+
+def main():
+    for count in SEGMENT_COUNTS:
+        segment_set = pathfinding.SegmentSet(generate_segments(count))
+
+        start = time.perf_counter()
+        labels = pathfinding.label_by_proximity(segment_set, min_size=1)
+        grid_ms = 1000 * (time.perf_counter() - start)
+
+        message = '%6i segments: grid %8.2f ms, %5i clusters' % (count, grid_ms, labels.max() + 1)
+
+        if count <= MAX_PAIRWISE_SEGMENTS:
+            line_list = segment_set.to_lines()
+
+            start = time.perf_counter()
+            clusters = cluster_by_proximity_pairwise(line_list)
+            pairwise_ms = 1000 * (time.perf_counter() - start)
+
+            same = get_components(line_list, clusters) == get_label_components(labels)
+            message += ', pairwise %9.2f ms (%6.1fx), same components: %s' % (pairwise_ms, pairwise_ms / grid_ms, same)
+
+        print(message)
+
+
+if __name__ == '__main__':
+    main()
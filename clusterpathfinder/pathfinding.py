@@ -11,42 +11,25 @@ def compute_turn_angle(image):
     # segment the frame horizontally
     subframe_list = split_frame(image, NUMBER_OF_SUBDIVISIONS)
 
-    # get line segments
-    # 2D array - list of lists of line segments
-    list_of_segment_lists = []
+    # get line segments, one SegmentSet per horizontal band of the frame
+    segment_sets = []
     for subframe in subframe_list:
-        line_segments, _ = get_line_segments(subframe)
-        list_of_segment_lists.append(line_segments)
+        segment_set, _ = get_segment_set(subframe)
+        segment_sets.append(segment_set)
 
-    # cluster lines by angle
-    clusters_list = []
-    for segment_list in list_of_segment_lists:
-        if len(segment_list) != 0:
-            clusters_list.append(cluster_by_angle(segment_list))  # cluster by angle takes a list of Line objects
-
-    # find longest line cluster
+    # cluster lines by angle and take the direction of the longest cluster of every band
     raw_output_list = []
-    for clusters in clusters_list:
-        # TODO: need to somehow find the longest cluster in a list of clusters
-        # each cluster is a list of line segments
-        # cluster_list is a 3D array
-
-        largest_cluster_length = 0
-        largest_cluster = None
-        for cluster in clusters:
-            cluster_magnitude = compute_cluster_magnitude(cluster)
-            if cluster_magnitude > largest_cluster_length:
-                largest_cluster_length = cluster_magnitude
-                largest_cluster = cluster
-
-        raw_output_list.append(compute_cluster_direction(largest_cluster))
+    for segment_set in segment_sets:
+        if len(segment_set) != 0:
+            _, magnitudes, directions = cluster_angles(segment_set)
+            raw_output_list.append(directions[np.argmax(magnitudes)])
 
     # logging message
     logging.debug('pathfinder.compute_turn_angle()')
     logging.debug('raw_output_list: %s' % raw_output_list)
 
     # generate weights for each subframe
-    #num_nonzero_segment_lists = sum(len(x) > 0 for x in list_of_segment_lists)
+    #num_nonzero_segment_lists = sum(len(x) > 0 for x in segment_sets)
     weight_list = generate_weight_list(NUMBER_OF_SUBDIVISIONS)
     #weight_list = generate_weight_list(num_nonzero_segment_lists)
 
@@ -112,10 +95,55 @@ class Cluster:
         self.position = compute_cluster_position(cluster)
 
 
-def get_line_segments(image):
+class SegmentSet:
     """
-    Find the line segments in the frame using HoughLinesP
-    :return:
+    Line segments held as arrays, the vectorized counterpart of a list of Line objects
+    """
+    def __init__(self, segments):
+        """
+        :param segments: HoughLinesP output, (x1, y1, x2, y2) per segment
+        """
+        self.segments = np.asarray(segments).reshape(-1, 4)
+
+        x1, y1, x2, y2 = self.segments.T.astype(np.float64)
+
+        # set length
+        dx = x2 - x1
+        dy = y2 - y1
+        self.length = np.hypot(dx, dy)
+
+        # compute line angle, same convention as Line
+        degs = -np.degrees(np.arctan2(-dy, dx) % (2 * np.pi))
+        degs[degs <= -180] += 180
+        self.angle = degs + 90
+
+        # set midpoint
+        self.midpoint = np.column_stack(((x1 + x2) / 2, (y1 + y2) / 2))
+
+    def __len__(self):
+        return len(self.segments)
+
+    def __getitem__(self, index):
+        subset = SegmentSet.__new__(SegmentSet)
+        subset.segments = self.segments[index]
+        subset.length = self.length[index]
+        subset.angle = self.angle[index]
+        subset.midpoint = self.midpoint[index]
+        return subset
+
+    @classmethod
+    def from_lines(cls, line_list):
+        return cls([(line.x1, line.y1, line.x2, line.y2) for line in line_list])
+
+    def to_lines(self):
+        return [Line(x1, y1, x2, y2) for x1, y1, x2, y2 in self.segments]
+
+
+def detect_segments(image):
+    """
+    Blur, edge detection and HoughLinesP
+    :param image:
+    :return: blurred image and array of segments (x1, y1, x2, y2), shape (N, 4)
     """
 
     #image = cv2.GaussianBlur(image, (5, 5), 0)
@@ -139,20 +167,35 @@ def get_line_segments(image):
 
     lines = cv2.HoughLinesP(mask_edges, 1, np.pi/180, threshold, min_line_length, max_line_gap)
 
+    if lines is None:
+        return image, np.zeros((0, 4), np.int32)
+
+    return image, lines.reshape(-1, 4)
+
+
+def get_segment_set(image):
+    """
+    Find the line segments in the frame using HoughLinesP
+    :return: SegmentSet and the blurred image
+    """
+    image, segments = detect_segments(image)
+
+    return SegmentSet(segments), image
+
+
+def get_line_segments(image):
+    """
+    Find the line segments in the frame using HoughLinesP
+    :return:
+    """
+    image, segments = detect_segments(image)
+
     # create list of Line objects
     line_object_list = []
 
-    try:
-        for line in lines:
-            # print repr(line)
-            x1 = line[0][0]
-            y1 = line[0][1]
-            x2 = line[0][2]
-            y2 = line[0][3]
-            line_object_list.append(Line(x1, y1, x2, y2))
-            cv2.line(image, (x1, y1), (x2, y2), (0, 255, 0), 2)
-    except:
-        pass
+    for x1, y1, x2, y2 in segments:
+        line_object_list.append(Line(x1, y1, x2, y2))
+        cv2.line(image, (x1, y1), (x2, y2), (0, 255, 0), 2)
 
     return line_object_list, image
 
@@ -170,23 +213,200 @@ def cluster_by_angle(line_list):
     return clusters
 
 
-def cluster_by_proximity(image, line_list):
-    clusters = []
+def label_by_angle(segment_set, max_step=5):
+    """
+    Vectorized cluster_by_angle: a new cluster starts wherever the angle jumps by more than
+    max_step degrees from the previous segment
+    :param segment_set:
+    :param max_step:
+    :return: cluster label of every segment, 0 to number of clusters - 1
+    """
+    new_cluster = np.empty(len(segment_set), dtype=bool)
+    new_cluster[:1] = True
+    new_cluster[1:] = np.abs(np.diff(segment_set.angle)) > max_step
 
-    for line in line_list:
-        clusters.append([line])
-        for query_line in line_list:
-            distance = compute_point_distance(line.midpoint, query_line.midpoint)
-            if distance <= 100 and abs(line.angle - query_line.angle) < 10:
-                clusters[-1].append(query_line)
-                cv2.line(image, line.midpoint, query_line.midpoint, (128, 128, 128), 1)
-
-    filtered_clusters = []
-    for cluster in clusters:
-        if len(cluster) >= CLUSTER_MIN_SIZE:
-            filtered_clusters.append(cluster)
-
-    return image, filtered_clusters
+    return np.cumsum(new_cluster) - 1
+
+
+def cluster_angles(segment_set, tolerance=5):
+    """
+    Cluster segments by angle independently of their order: angles are sorted and a new cluster
+    starts wherever two consecutive angles are more than tolerance degrees apart. Angles live in
+    (-90, 90], where -90 and 90 are the same direction, so the first and last clusters are merged
+    when they are close across the wraparound.
+    :param segment_set:
+    :param tolerance: maximum angle difference (degrees) between consecutive segments of a cluster
+    :return: cluster label of every segment, total length and mean angle of every cluster
+    """
+    angle = segment_set.angle
+    order = np.argsort(angle, kind='stable')
+    sorted_angle = angle[order]
+
+    new_cluster = np.empty(len(angle), dtype=bool)
+    new_cluster[:1] = True
+    new_cluster[1:] = np.diff(sorted_angle) > tolerance
+    sorted_labels = np.cumsum(new_cluster) - 1
+
+    # the segments wrapping around are unwrapped to just below -90 to average them
+    unwrapped_angle = sorted_angle.copy()
+    last_label = sorted_labels[-1] if len(angle) else 0
+    if last_label > 0 and sorted_angle[0] + 180 - sorted_angle[-1] <= tolerance:
+        wrapped = sorted_labels == last_label
+        sorted_labels[wrapped] = 0
+        unwrapped_angle[wrapped] -= 180
+
+    labels = np.empty_like(sorted_labels)
+    labels[order] = sorted_labels
+
+    counts = np.bincount(sorted_labels)
+    magnitudes = np.bincount(sorted_labels, weights=segment_set.length[order])
+    directions = np.bincount(sorted_labels, weights=unwrapped_angle) / np.maximum(counts, 1)
+    directions[directions <= -90] += 180
+
+    # a merged last cluster leaves an empty label behind
+    if len(counts) and counts[-1] == 0:
+        magnitudes, directions = magnitudes[:-1], directions[:-1]
+
+    return labels, magnitudes, directions
+
+
+def compute_cluster_magnitudes(segment_set, labels):
+    """
+    Total segment length of every cluster
+    """
+    return np.bincount(labels, weights=segment_set.length)
+
+
+def compute_cluster_directions(segment_set, labels):
+    """
+    Mean segment angle of every cluster
+    """
+    return np.bincount(labels, weights=segment_set.angle) / np.bincount(labels)
+
+
+def compute_cluster_positions(segment_set, labels):
+    """
+    Mean segment midpoint of every cluster, shape (number of clusters, 2)
+    """
+    counts = np.bincount(labels)
+    return np.column_stack((np.bincount(labels, weights=segment_set.midpoint[:, 0]) / counts,
+                            np.bincount(labels, weights=segment_set.midpoint[:, 1]) / counts))
+
+
+def get_proximity_pairs(segment_set, max_distance=100, max_angle=10):
+    """
+    Find all pairs of segments with midpoints at most max_distance apart and angles less than
+    max_angle degrees apart, using a uniform grid over (x, y, angle) with max_distance by
+    max_distance by max_angle cells: only segments in the same or in adjacent cells are compared
+    :param segment_set:
+    :param max_distance:
+    :param max_angle:
+    :return: arrays of first and second segment index of every pair (each pair once)
+    """
+    if len(segment_set) == 0:
+        return np.zeros(0, np.int64), np.zeros(0, np.int64)
+
+    midpoint = segment_set.midpoint
+    angle = segment_set.angle
+
+    cells = np.floor(np.column_stack((midpoint / max_distance, angle / max_angle))).astype(np.int64)
+    cells -= cells.min(axis=0)
+
+    # one key per cell, the strides leave room for the neighbour offsets
+    strides = cells.max(axis=0) + 3
+    keys = (cells[:, 0] * strides[1] + cells[:, 1]) * strides[2] + cells[:, 2]
+
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+    cell_keys, cell_starts, cell_counts = np.unique(sorted_keys, return_index=True, return_counts=True)
+
+    # half of the neighbourhood, so every pair of cells is visited once
+    offsets = [(dx, dy, da) for dx in (-1, 0, 1) for dy in (-1, 0, 1) for da in (-1, 0, 1)]
+    offsets = offsets[len(offsets) // 2:]
+
+    first, second = [], []
+
+    for dx, dy, da in offsets:
+        neighbour_keys = sorted_keys + (dx * strides[1] + dy) * strides[2] + da
+        neighbour_cells = np.minimum(np.searchsorted(cell_keys, neighbour_keys), len(cell_keys) - 1)
+        exists = cell_keys[neighbour_cells] == neighbour_keys
+
+        sources = np.flatnonzero(exists)
+        counts = cell_counts[neighbour_cells[sources]]
+        starts = cell_starts[neighbour_cells[sources]]
+
+        # every segment of the cell against every segment of the neighbour cell
+        pair_sources = np.repeat(sources, counts)
+        pair_targets = np.arange(counts.sum()) + np.repeat(starts - (np.cumsum(counts) - counts), counts)
+
+        if dx == 0 and dy == 0 and da == 0:
+            keep = pair_targets > pair_sources
+            pair_sources, pair_targets = pair_sources[keep], pair_targets[keep]
+
+        pair_first, pair_second = order[pair_sources], order[pair_targets]
+
+        close = np.abs(angle[pair_first] - angle[pair_second]) < max_angle
+        pair_first, pair_second = pair_first[close], pair_second[close]
+
+        delta = midpoint[pair_first] - midpoint[pair_second]
+        close = np.einsum('ij,ij->i', delta, delta) <= max_distance ** 2
+
+        first.append(pair_first[close])
+        second.append(pair_second[close])
+
+    return np.concatenate(first), np.concatenate(second)
+
+
+def label_by_proximity(segment_set, max_distance=100, max_angle=10, min_size=CLUSTER_MIN_SIZE):
+    """
+    Cluster segments by proximity: connected components of the graph linking segments with close
+    midpoints and similar angles
+    :param segment_set:
+    :param max_distance: maximum distance between the midpoints of two linked segments
+    :param max_angle: maximum angle difference (degrees) between two linked segments
+    :param min_size: clusters with fewer segments are dropped
+    :return: cluster label of every segment, 0 to number of clusters - 1, or -1 if dropped
+    """
+    first, second = get_proximity_pairs(segment_set, max_distance, max_angle)
+
+    # label propagation with pointer jumping, every segment ends up with the smallest index of its component
+    labels = np.arange(len(segment_set))
+    while True:
+        previous = labels.copy()
+        np.minimum.at(labels, first, labels[second])
+        np.minimum.at(labels, second, labels[first])
+        labels = labels[labels]
+        if np.array_equal(labels, previous):
+            break
+
+    _, labels, sizes = np.unique(labels, return_inverse=True, return_counts=True)
+
+    # drop the small clusters and renumber the others
+    kept = sizes >= min_size
+    new_labels = np.where(kept, np.cumsum(kept) - 1, -1)
+
+    return new_labels[labels]
+
+
+def cluster_by_proximity(image, segment_set):
+    """
+    Cluster segments by proximity, see label_by_proximity
+    :param image: if not None, every clustered segment midpoint is linked to its cluster center on it
+    :param segment_set: SegmentSet or list of Line objects
+    :return: image and cluster label of every segment (-1 if not clustered)
+    """
+    if not isinstance(segment_set, SegmentSet):
+        segment_set = SegmentSet.from_lines(segment_set)
+
+    labels = label_by_proximity(segment_set)
+
+    if image is not None and labels.max(initial=-1) >= 0:
+        clustered = labels >= 0
+        positions = compute_cluster_positions(segment_set[clustered], labels[clustered])
+        for midpoint, label in zip(segment_set.midpoint[clustered], labels[clustered]):
+            cv2.line(image, tuple(map(int, midpoint)), tuple(map(int, positions[label])), (128, 128, 128), 1)
+
+    return image, labels
 
 
 def compute_point_distance(p1, p2):
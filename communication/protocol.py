@@ -0,0 +1,270 @@
+'''
+Binary framed protocol between the computer and the Arduino Master
+
+Command frame (computer -> Arduino), 6 bytes:
+
+    0xA5 | seq | angle | speed | mode | crc
+
+Acknowledgement frame (Arduino -> computer), 4 bytes:
+
+    0xA6 | seq | status | crc
+
+Every field is one unsigned byte. seq counts frames modulo 256 and is echoed
+by the acknowledgement. The crc is the CRC-8 (polynomial 0x07, initial value 0)
+of all the preceding bytes of the frame, sync byte included. Both sync bytes
+are outside of the ASCII range, so acknowledgements can be told apart from the
+text lines the Arduino keeps printing (fault status, heartbeat).
+
+ReferenceFirmware is the Python reference of the Arduino side, so the protocol
+can be tested without hardware.
+'''
+
+import collections
+
+COMMAND_SYNC = 0xA5
+ACK_SYNC = 0xA6
+
+COMMAND_SIZE = 6
+ACK_SIZE = 4
+
+# mode field of the command frames
+MODE_KEEP = 0
+MODE_MANUAL = 1
+MODE_AUTO = 2
+MODES = (MODE_KEEP, MODE_MANUAL, MODE_AUTO)
+
+# status field of the acknowledgements
+STATUS_OK = 0
+STATUS_STOPPED = 1
+STATUS_BAD_MODE = 2
+
+CRC_POLYNOMIAL = 0x07
+
+Command = collections.namedtuple('Command', ['seq', 'angle', 'speed', 'mode'])
+Ack = collections.namedtuple('Ack', ['seq', 'status'])
+
+
+def _make_crc_table():
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = ((crc << 1) ^ CRC_POLYNOMIAL) & 0xFF if crc & 0x80 else (crc << 1) & 0xFF
+        table.append(crc)
+    return bytes(table)
+
+CRC_TABLE = _make_crc_table()
+
+
+def crc8(data, crc=0):
+    """
+    CRC-8 with polynomial 0x07 (no reflection, no final xor)
+
+    :param data: bytes
+    :param crc: initial value, or the crc of the preceding bytes
+    :return: crc as an integer
+    """
+    for byte in data:
+        crc = CRC_TABLE[crc ^ byte]
+    return crc
+
+
+def _check_byte(name, value):
+    if not 0 <= value <= 255:
+        raise ValueError('%s out of range [0, 255]: %s' % (name, value))
+    return value
+
+
+def encode_command(seq, angle, speed, mode=MODE_KEEP):
+    """
+    :param seq: sequence number, taken modulo 256
+    :param angle: steering angle, 0 to 255 (the servo clamps to 180)
+    :param speed: speed (PWM duty), 0 to 255
+    :param mode: MODE_KEEP, MODE_MANUAL or MODE_AUTO
+    :return: command frame, bytes
+    """
+    if mode not in MODES:
+        raise ValueError('unknown mode: %s' % mode)
+    frame = bytes((COMMAND_SYNC, seq & 0xFF, _check_byte('angle', angle), _check_byte('speed', speed), mode))
+    return frame + bytes((crc8(frame),))
+
+
+def encode_ack(seq, status=STATUS_OK):
+    """
+    :param seq: sequence number of the acknowledged command
+    :param status: STATUS_OK, STATUS_STOPPED or STATUS_BAD_MODE
+    :return: acknowledgement frame, bytes
+    """
+    frame = bytes((ACK_SYNC, seq & 0xFF, _check_byte('status', status)))
+    return frame + bytes((crc8(frame),))
+
+
+def decode_command(frame):
+    """
+    :param frame: COMMAND_SIZE bytes starting with COMMAND_SYNC
+    :return: Command, or None if the frame is corrupted
+    """
+    if len(frame) != COMMAND_SIZE or frame[0] != COMMAND_SYNC or crc8(frame) != 0:
+        return None
+    return Command(*frame[1:5])
+
+
+def decode_ack(frame):
+    """
+    :param frame: ACK_SIZE bytes starting with ACK_SYNC
+    :return: Ack, or None if the frame is corrupted
+    """
+    if len(frame) != ACK_SIZE or frame[0] != ACK_SYNC or crc8(frame) != 0:
+        return None
+    return Ack(*frame[1:3])
+
+
+class FrameDecoder:
+    """
+    Extracts the frames of one kind from a byte stream
+
+    Bytes before a sync byte are skipped. When a candidate frame fails its crc only its
+    sync byte is dropped, so a frame starting inside the corrupted one is still found.
+    """
+    def __init__(self, sync, size, decode):
+        """
+        :param sync: sync byte of the frames
+        :param size: frame size, in bytes
+        :param decode: function turning a frame into its value, None if corrupted
+        """
+        self.sync = sync
+        self.size = size
+        self.decode = decode
+
+        self.buffer = bytearray()
+        self.crc_errors = 0
+        self.skipped = 0
+
+    def feed(self, data):
+        """
+        :param data: received bytes
+        :return: list of the decoded frames completed by data
+        """
+        self.buffer += data
+        frames = []
+
+        while True:
+            start = self.buffer.find(self.sync)
+            if start < 0:
+                self.skipped += len(self.buffer)
+                self.buffer.clear()
+                break
+
+            self.skipped += start
+            del self.buffer[:start]
+            if len(self.buffer) < self.size:
+                break
+
+            value = self.decode(bytes(self.buffer[:self.size]))
+            if value is None:
+                self.crc_errors += 1
+                del self.buffer[:1]
+                continue
+
+            frames.append(value)
+            del self.buffer[:self.size]
+
+        return frames
+
+
+class ReplyDecoder:
+    """
+    Splits what the Arduino sends into text lines and acknowledgement frames
+    """
+    def __init__(self):
+        self.buffer = bytearray()
+        self.crc_errors = 0
+
+    def feed(self, data):
+        """
+        :param data: received bytes
+        :return: list of the completed replies, str for text lines (without line ending) and Ack
+        """
+        self.buffer += data
+        replies = []
+
+        while self.buffer:
+            if self.buffer[0] == ACK_SYNC:
+                if len(self.buffer) < ACK_SIZE:
+                    break
+
+                ack = decode_ack(bytes(self.buffer[:ACK_SIZE]))
+                if ack is None:
+                    # not an acknowledgement, the sync byte is noise
+                    self.crc_errors += 1
+                    del self.buffer[:1]
+                    continue
+
+                replies.append(ack)
+                del self.buffer[:ACK_SIZE]
+                continue
+
+            # text up to the end of the line, or up to an acknowledgement cutting in
+            end = self.buffer.find(b'\n')
+            sync = self.buffer.find(ACK_SYNC)
+            if 0 <= sync and (end < 0 or sync < end):
+                line, self.buffer = self.buffer[:sync], self.buffer[sync:]
+            elif end >= 0:
+                line, self.buffer = self.buffer[:end], self.buffer[end + 1:]
+            else:
+                break
+
+            line = line.strip(b'\r').decode('ascii', errors='replace')
+            if line:
+                replies.append(line)
+
+        return replies
+
+
+class ReferenceFirmware:
+    """
+    Python reference of the Arduino side of the binary protocol
+
+    Decodes command frames, applies them like setAngle/setSpeed do and answers each valid
+    frame with an acknowledgement. Corrupted frames are not acknowledged, the computer
+    notices the missing sequence number.
+    """
+    def __init__(self, angle=90, speed=0, mode=MODE_MANUAL):
+        """
+        :param angle: initial steering angle (firmware default)
+        :param speed: initial speed (firmware default)
+        :param mode: initial mode
+        """
+        self.angle = angle
+        self.speed = speed
+        self.mode = mode
+        self.estop_triggered = False
+
+        self.decoder = FrameDecoder(COMMAND_SYNC, COMMAND_SIZE, decode_command)
+
+    def receive(self, data):
+        """
+        :param data: bytes received from the computer
+        :return: bytes to send back
+        """
+        replies = bytearray()
+        for command in self.decoder.feed(data):
+            replies += encode_ack(command.seq, self.apply(command))
+        return bytes(replies)
+
+    def apply(self, command):
+        """
+        :return: acknowledgement status
+        """
+        if self.estop_triggered:
+            # the emergency stop holds the car until reset
+            return STATUS_STOPPED
+
+        if command.mode not in MODES:
+            return STATUS_BAD_MODE
+        if command.mode != MODE_KEEP:
+            self.mode = command.mode
+
+        self.angle = command.angle
+        self.speed = command.speed
+        return STATUS_OK
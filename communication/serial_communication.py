@@ -1,72 +1,708 @@
+import os
 import serial
 import time
 import threading
 import queue
-from curtsies import Input # pip3 install curtsies
+import collections
+import atexit
 import logging
 
-SERIAL_PORT = '/dev/ttyUSB0'
+try:
+    from . import protocol
+except ImportError:
+    import protocol
+
+# can be pointed at another device, e.g. the port of simulator.py
+SERIAL_PORT = os.environ.get('SERIAL_PORT', '/dev/ttyUSB0')
 BAUD_RATE = 9600
 
-def read_serial_thread(q):
-    connected = False
+# 'ascii' sends one text message per command ('a90', 's30'), 'binary' sends steering angle
+# and speed together in one checksummed frame (see protocol.py). arduino_master.ino does not
+# decode binary frames yet, so get_scheduler refuses 'binary' (simulator.py can decode them)
+PROTOCOL = 'ascii'
 
-    try:
-        ser = serial.Serial(SERIAL_PORT, BAUD_RATE, timeout=0)
-
-        while not connected:
-            connected = True
-
-            while ser.isOpen():
-                if (ser.inWaiting() > 0):
-                    data_str = ser.read(ser.inWaiting()).decode('ascii')
-                    print(data_str, end='')
-                stay_alive = True
-                if not q.empty():
-                    stay_alive = q.get()
-                if not stay_alive:
+# the Arduino splits messages on gaps in the byte stream, it reads one byte every 5 ms
+# and prints its reply, so messages must be spaced out
+MESSAGE_INTERVAL = 0.05
+
+# opening the port resets the Arduino, its setup takes about 2 s
+RESET_DELAY = 2.5
+
+# time between two connection attempts while the port is missing
+RECONNECT_INTERVAL = 1.0
+
+# pending messages, the oldest ones are dropped when the car falls behind
+QUEUE_SIZE = 8
+
+# time to wait for the pending messages when exiting
+FLUSH_TIMEOUT = 1.0
+
+# commands per second and per channel the scheduler sends at most
+COMMAND_RATE = 10
+
+# changes smaller than or equal to this are not sent, per channel
+COMMAND_DEADBANDS = {'a': 1, 's': 0}
+
+# state of the Arduino after a reset, binary frames carry these until a value is set
+COMMAND_DEFAULTS = {'a': 90, 's': 0}
+
+# a binary frame not acknowledged within this time is sent again, in seconds
+ACK_TIMEOUT = 0.2
+
+# unacknowledged frames in a row after which the Arduino is reported as not answering
+MAX_UNACKNOWLEDGED = 10
+
+# reads block for at most this long, so the reader thread notices when it is stopped
+READ_BLOCK_TIMEOUT = 0.1
+
+# read_serial gives up after this time, in seconds
+READ_TIMEOUT = 1.0
+
+# events waiting in a subscriber queue, the oldest ones are dropped when it is full
+EVENT_QUEUE_SIZE = 32
+
+# kind of the replies of the Arduino, by prefix (see README.md)
+REPLY_KINDS = {
+    'A': 'angle',
+    'S': 'speed',
+    'M': 'mode',
+    'E': 'error',
+    'F': 'fault',
+    'HB': 'heartbeat',
+}
+
+# replies without value
+STATUS_KINDS = {
+    'R': 'reset',
+    'RESET': 'reset',
+    'STOP': 'stop',
+}
+
+# reply kinds holding an integer value
+INTEGER_KINDS = ('angle', 'speed', 'heartbeat')
+
+# reply kinds read_serial returns, the answers to commands
+COMMAND_REPLY_KINDS = ('angle', 'speed', 'mode', 'error', 'reset', 'ack')
+
+# a line received from the Arduino: kind of reply, parsed value, raw line and reception time
+SerialEvent = collections.namedtuple('SerialEvent', ['kind', 'value', 'line', 'time'])
+
+
+def parse_reply(line):
+    """
+    Parse a line sent by the Arduino
+
+    :param line: line without its line ending, e.g. 'A:90'
+    :return: SerialEvent, kind 'text' for lines that are not replies (e.g. fault pin status)
+    """
+    received = time.monotonic()
+
+    if line in STATUS_KINDS:
+        return SerialEvent(STATUS_KINDS[line], None, line, received)
+
+    prefix, separator, value = line.partition(':')
+    kind = REPLY_KINDS.get(prefix) if separator else None
+
+    if kind is None:
+        return SerialEvent('text', line, line, received)
+
+    if kind in INTEGER_KINDS:
+        try:
+            value = int(value)
+        except ValueError:
+            return SerialEvent('text', line, line, received)
+
+    return SerialEvent(kind, value, line, received)
+
+
+def parse_ack(ack):
+    """
+    :param ack: protocol.Ack received from the Arduino
+    :return: SerialEvent of kind 'ack', line e.g. 'ACK:12:0' (sequence number and status)
+    """
+    return SerialEvent('ack', ack, 'ACK:%d:%d' % ack, time.monotonic())
+
+
+class SerialLink:
+    """
+    Persistent connection to the Arduino
+
+    The port is opened once and reopened when it drops. Messages are written by a
+    background thread from a bounded queue, so senders never block.
+    """
+    def __init__(self, port=SERIAL_PORT, baud_rate=BAUD_RATE, queue_size=QUEUE_SIZE,
+                 message_interval=MESSAGE_INTERVAL, reset_delay=RESET_DELAY,
+                 reconnect_interval=RECONNECT_INTERVAL):
+        self.port = port
+        self.baud_rate = baud_rate
+        self.message_interval = message_interval
+        self.reset_delay = reset_delay
+        self.reconnect_interval = reconnect_interval
+
+        self.serial = None
+        self.dropped = 0
+
+        # incremented on every (re)connection, the Arduino has forgotten its state each time
+        self.connection_count = 0
+
+        self._queue = collections.deque(maxlen=queue_size)
+        self._condition = threading.Condition()
+        self._connect_lock = threading.Lock()
+        self._connected = threading.Event()
+        self._stopped = False
+
+        self._writer = threading.Thread(target=self._run, name='serial-writer', daemon=True)
+        self._writer.start()
+
+    @property
+    def connected(self):
+        return self.serial is not None
+
+    def send(self, message):
+        """
+        Queue a message, the oldest pending message is dropped if the queue is full
+
+        :param message: message string, e.g. 'a90', or bytes (binary frame)
+        """
+        if not message:
+            return
+        if isinstance(message, str):
+            message = message.encode('ascii')
+
+        with self._condition:
+            if len(self._queue) == self._queue.maxlen:
+                self.dropped += 1
+                logging.debug('serial queue full, dropping: %s' % self._queue[0])
+            self._queue.append(message)
+            self._condition.notify()
+
+    def pending(self):
+        with self._condition:
+            return len(self._queue)
+
+    def connect(self):
+        """
+        Open the port if it is not open yet
+
+        :return: True if connected
+        """
+        with self._connect_lock:
+            if self.serial is not None:
+                return True
+
+            try:
+                ser = serial.Serial(self.port, self.baud_rate, timeout=READ_BLOCK_TIMEOUT)
+            except serial.serialutil.SerialException:
+                logging.debug('Serial port not found')
+                return False
+
+            logging.debug('connected to %s, waiting for the Arduino to reset' % self.port)
+            time.sleep(self.reset_delay)
+            ser.reset_input_buffer()
+
+            self.serial = ser
+            self.connection_count += 1
+            self._connected.set()
+            return True
+
+    def disconnect(self):
+        with self._connect_lock:
+            if self.serial is not None:
+                self._connected.clear()
+                try:
+                    self.serial.close()
+                except serial.serialutil.SerialException:
+                    pass
+                self.serial = None
+
+    def wait_connected(self, timeout=None):
+        """
+        Block until the port is open
+
+        :return: True if connected
+        """
+        return self._connected.wait(timeout)
+
+    def close(self, flush=True, timeout=FLUSH_TIMEOUT):
+        """
+        Stop the writer thread and close the port
+
+        :param flush: if True, pending messages are written first (up to timeout)
+        :param timeout: maximum time to wait for the pending messages, in seconds
+        """
+        deadline = time.monotonic() + timeout
+
+        with self._condition:
+            while flush and self._queue and self.connected and time.monotonic() < deadline:
+                self._condition.wait(deadline - time.monotonic())
+
+            self._stopped = True
+            self._condition.notify_all()
+
+        self._writer.join(timeout)
+        self.disconnect()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if self._stopped:
                     return
-            print('end')
-    except serial.serialutil.SerialException:
-        print('Serial port not found')
-        return
 
-def read_serial():
-    connected = False
+            # connect right away, readers share the connection
+            if not self.connect():
+                with self._condition:
+                    self._condition.wait(self.reconnect_interval)
+                continue
 
-    try:
-        ser = serial.Serial(SERIAL_PORT, BAUD_RATE, timeout=0)
+            with self._condition:
+                while not self._queue and not self._stopped and self.connected:
+                    self._condition.wait(self.reconnect_interval)
+                if self._stopped:
+                    return
+                if not self._queue:
+                    continue
+                message = self._queue.popleft()
 
-        while not connected:
-            connected = True
+            logging.debug('writing message: %s' % message)
 
-            while ser.isOpen():
-                if (ser.inWaiting() > 0):
-                    data_str = ser.read(ser.inWaiting()).decode('ascii')
-                    #print(data_str)
-                    return data_str.replace('\n', '').replace('\r','')
-            #print('end')
-    except serial.serialutil.SerialException:
-        print('Serial port not found')
-        return
+            try:
+                self.serial.write(message)
+            except (serial.serialutil.SerialException, OSError, AttributeError):
+                logging.debug('Serial port lost, reconnecting')
+                self.disconnect()
 
-def write_serial_message(message):
-    message = message.encode('ascii')
-    logging.debug('writing message: %s' % message)
+                # retry the message after reconnecting, unless newer ones filled the queue
+                with self._condition:
+                    if len(self._queue) < self._queue.maxlen:
+                        self._queue.appendleft(message)
+                continue
+
+            with self._condition:
+                # wakes up close() waiting for the queue to drain
+                self._condition.notify_all()
+
+            time.sleep(self.message_interval)
+
+
+class CommandScheduler:
+    """
+    Sends the latest value of every command channel ('a' steering angle, 's' speed)
+
+    Each channel has a single slot, a new value replaces the one waiting to be sent. A value
+    is skipped if it is within the deadband of the last value sent on its channel, and every
+    channel is sent at most rate times per second, and only once the link has written the
+    previous messages, so the car always acts on the newest decision.
+    """
+    def __init__(self, link, rate=COMMAND_RATE, deadbands=COMMAND_DEADBANDS):
+        """
+        :param link: SerialLink the commands are sent through
+        :param rate: maximum number of commands per second and per channel
+        :param deadbands: dict channel -> largest change that is not sent
+        """
+        self.link = link
+        self.period = 1. / rate
+        self.deadbands = dict(deadbands)
+
+        self._slots = {}
+        self._last_sent = {}
+        self._last_time = {}
+        self._connection_count = link.connection_count
+
+        self._condition = threading.Condition()
+        self._stopped = False
+
+        self._sender = threading.Thread(target=self._run, name='command-scheduler', daemon=True)
+        self._sender.start()
+
+    def set(self, channel, value):
+        """
+        Set the newest value of a channel, never blocks
+
+        :param channel: 'a' or 's'
+        :param value: numeric value, rounded to an integer
+        """
+        with self._condition:
+            self._slots[channel] = int(round(value))
+            self._condition.notify()
+
+    def close(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        self._sender.join()
+
+    def _next_command(self):
+        """
+        Take the first channel value that is due, dropping the ones within the deadband
+
+        :return: (channel, value) or None, and the time to wait before checking again
+        """
+        # after a reconnection the Arduino is back to its defaults, the last values sent must be
+        # sent again (unless newer ones are waiting)
+        if self.link.connection_count != self._connection_count:
+            self._connection_count = self.link.connection_count
+            for channel, value in self._last_sent.items():
+                self._slots.setdefault(channel, value)
+            self._last_sent.clear()
+
+        now = time.monotonic()
+        wait = None
+
+        for channel in list(self._slots):
+            value = self._slots[channel]
+            last_sent = self._last_sent.get(channel)
 
+            if last_sent is not None and abs(value - last_sent) <= self.deadbands.get(channel, 0):
+                del self._slots[channel]
+                continue
+
+            due = self._last_time.get(channel, 0.) + self.period - now
+            if due > 0:
+                wait = due if wait is None else min(wait, due)
+                continue
+
+            del self._slots[channel]
+            self._last_sent[channel] = value
+            self._last_time[channel] = now
+            return (channel, value), None
+
+        return None, wait
+
+    def _run(self):
+        with self._condition:
+            while not self._stopped:
+                # values stay in their slot until the link has caught up
+                if not self.link.connected or self.link.pending() > 0:
+                    self._condition.wait(self.link.message_interval)
+                    continue
+
+                command, wait = self._next_command()
+                if command is None:
+                    # wakes up regularly to notice a reconnection, even with nothing to send
+                    self._condition.wait(self.link.message_interval if wait is None else wait)
+                    continue
+
+                self._send(command)
+
+    def _send(self, command):
+        self.link.send('%s%d' % command)
+
+
+class BinaryCommandScheduler(CommandScheduler):
+    """
+    CommandScheduler sending binary frames (see protocol.py)
+
+    A frame carries the steering angle and the speed at once, so whenever a channel is due
+    the newest values of all channels go out together, in 6 bytes instead of up to two
+    text messages.
+
+    Every frame carries a sequence number that the Arduino echoes in its acknowledgement. If
+    the last frame sent is not acknowledged within ack_timeout (lost, corrupted, or the Arduino
+    reset), the newest values are sent again in a new frame. A newer frame replaces the one
+    waiting for its acknowledgement, as it carries the complete state.
+    """
+    def __init__(self, link, reader, rate=COMMAND_RATE, deadbands=COMMAND_DEADBANDS, defaults=COMMAND_DEFAULTS,
+                 ack_timeout=ACK_TIMEOUT):
+        """
+        :param reader: SerialReader of the link, delivering the acknowledgements
+        :param defaults: dict channel -> value sent until the channel is set
+        :param ack_timeout: time after which an unacknowledged frame is sent again, in seconds
+        """
+        # values carried by the frames, the last ones sent for every channel
+        self.values = dict(defaults)
+        self.seq = 0
+        self.ack_timeout = ack_timeout
+
+        # frames that were not acknowledged in time, and frames acknowledged with an error status
+        self.failures = 0
+        self.rejected = 0
+        # frames in a row that were not acknowledged in time
+        self.unacknowledged = 0
+
+        # sequence number and deadline of the frame waiting for its acknowledgement
+        self._outstanding = None
+
+        self.reader = reader
+        self._acks = reader.subscribe(['ack'])
+
+        super().__init__(link, rate, deadbands)
+
+    def close(self):
+        super().close()
+        self.reader.unsubscribe(self._acks)
+
+    def _process_acks(self):
+        while True:
+            try:
+                ack = self._acks.get_nowait().value
+            except queue.Empty:
+                return
+
+            # acknowledgements of older frames are stale, a newer frame is on its way
+            if self._outstanding is None or ack.seq != self._outstanding[0]:
+                continue
+
+            self._outstanding = None
+            self.unacknowledged = 0
+            if ack.status != protocol.STATUS_OK:
+                self.rejected += 1
+                logging.debug('frame %d rejected, status %d' % (ack.seq, ack.status))
+
+    def _next_command(self):
+        self._process_acks()
+
+        command, wait = super()._next_command()
+        if command is not None or self._outstanding is None:
+            return command, wait
+
+        remaining = self._outstanding[1] - time.monotonic()
+        if remaining > 0:
+            return None, remaining if wait is None else min(wait, remaining)
+
+        self.failures += 1
+        self.unacknowledged += 1
+        logging.debug('frame %d not acknowledged, sending again' % self._outstanding[0])
+        if self.unacknowledged == MAX_UNACKNOWLEDGED:
+            logging.error('%d binary frames in a row not acknowledged, does the Arduino firmware decode them?'
+                          % self.unacknowledged)
+
+        # the frame carries every channel, resending any of them sends the newest state
+        return ('a', self.values['a']), None
+
+    def _send(self, command):
+        channel, value = command
+        self.values[channel] = value
+
+        # newer values waiting on the other channels share the frame
+        now = time.monotonic()
+        for other, other_value in self._slots.items():
+            self.values[other] = self._last_sent[other] = other_value
+            self._last_time[other] = now
+        self._slots.clear()
+
+        angle, speed = (min(max(self.values[key], 0), 255) for key in ('a', 's'))
+        self.link.send(protocol.encode_command(self.seq, angle, speed))
+
+        self._outstanding = (self.seq, now + self.ack_timeout)
+        self.seq = (self.seq + 1) & 0xFF
+
+
+class SerialReader:
+    """
+    Reads the replies of the Arduino on the shared connection and publishes them as events
+
+    A background thread blocks on the port, splits the stream into text lines and binary
+    acknowledgements, and parses them (see parse_reply and parse_ack). Every subscriber gets
+    its own bounded queue, dropping its oldest events when it does not keep up, so a slow
+    subscriber never holds up the others.
+    """
+    def __init__(self, link):
+        """
+        :param link: SerialLink to read from
+        """
+        self.link = link
+
+        self._subscribers = []
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+        self._thread = threading.Thread(target=self._run, name='serial-reader', daemon=True)
+        self._thread.start()
+
+    def subscribe(self, kinds=None, maxsize=EVENT_QUEUE_SIZE):
+        """
+        :param kinds: event kinds to receive, None for all of them
+        :param maxsize: size of the queue
+        :return: queue.Queue receiving the SerialEvent objects
+        """
+        subscription = queue.Queue(maxsize)
+        with self._lock:
+            self._subscribers.append((subscription, None if kinds is None else frozenset(kinds)))
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers = [(q, kinds) for q, kinds in self._subscribers if q is not subscription]
+
+    def close(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def publish(self, event):
+        with self._lock:
+            subscribers = list(self._subscribers)
+
+        for subscription, kinds in subscribers:
+            if kinds is not None and event.kind not in kinds:
+                continue
+
+            while True:
+                try:
+                    subscription.put_nowait(event)
+                    break
+                except queue.Full:
+                    try:
+                        subscription.get_nowait()
+                    except queue.Empty:
+                        pass
+
+    def _run(self):
+        decoder = protocol.ReplyDecoder()
+
+        while not self._stopped.is_set():
+            ser = self.link.serial
+            if ser is None:
+                # a partial line from before the connection dropped is meaningless
+                decoder = protocol.ReplyDecoder()
+                self.link.wait_connected(READ_BLOCK_TIMEOUT)
+                continue
+
+            try:
+                # blocks until at least one byte arrives (or READ_BLOCK_TIMEOUT)
+                data = ser.read(max(1, ser.in_waiting))
+            except (serial.serialutil.SerialException, OSError, TypeError, AttributeError):
+                logging.debug('Serial port lost')
+                self.link.disconnect()
+                continue
+
+            for reply in decoder.feed(data):
+                if isinstance(reply, protocol.Ack):
+                    self.publish(parse_ack(reply))
+                else:
+                    self.publish(parse_reply(reply))
+
+
+_link = None
+_scheduler = None
+_reader = None
+_read_subscription = None
+_link_lock = threading.Lock()
+
+def get_link():
+    """
+    Shared SerialLink used by the module level functions, created on first use
+    """
+    global _link
+
+    with _link_lock:
+        if _link is None:
+            # settings read now, so they can be changed after importing the module
+            _link = SerialLink(port=SERIAL_PORT, baud_rate=BAUD_RATE, reset_delay=RESET_DELAY)
+            atexit.register(_link.close)
+
+    return _link
+
+def get_scheduler():
+    """
+    Shared CommandScheduler of the shared link, created on first use
+    """
+    global _scheduler
+
+    if PROTOCOL != 'ascii':
+        # arduino_master.ino answers every binary frame with E:len, nothing would be applied
+        raise ValueError("Unsupported PROTOCOL %r: arduino_master.ino only reads 'ascii' commands" % PROTOCOL)
+
+    link = get_link()
+
+    with _link_lock:
+        if _scheduler is None:
+            _scheduler = CommandScheduler(link)
+
+    return _scheduler
+
+def get_reader():
+    """
+    Shared SerialReader of the shared link, created on first use
+    """
+    global _reader
+
+    link = get_link()
+
+    with _link_lock:
+        if _reader is None:
+            _reader = SerialReader(link)
+
+    return _reader
+
+def set_angle(angle):
+    """
+    Request a steering angle, only the newest request is sent (see CommandScheduler)
+    """
+    get_scheduler().set('a', angle)
+
+def set_speed(speed):
+    """
+    Request a speed, only the newest request is sent (see CommandScheduler)
+    """
+    get_scheduler().set('s', speed)
+
+def read_serial_thread(q):
+    subscription = get_reader().subscribe()
+
+    while True:
+        stay_alive = True
+        if not q.empty():
+            stay_alive = q.get()
+        if not stay_alive:
+            break
+
+        try:
+            event = subscription.get(timeout=READ_BLOCK_TIMEOUT)
+        except queue.Empty:
+            continue
+        print(event.line)
+
+    get_reader().unsubscribe(subscription)
+
+def get_read_subscription():
+    """
+    Subscription of read_serial to the replies to commands, created on first use
+    """
+    global _read_subscription
+
+    reader = get_reader()
+
+    with _link_lock:
+        if _read_subscription is None:
+            _read_subscription = reader.subscribe(COMMAND_REPLY_KINDS)
+
+    return _read_subscription
+
+def read_serial(timeout=READ_TIMEOUT):
+    """
+    Wait for the next reply to a command (A:, S:, M:, E:, R or a binary acknowledgement)
+
+    Replies received before the last write_serial_message are dropped, so this returns the
+    answer to the last message written rather than an older one.
+
+    :param timeout: maximum time to wait, in seconds
+    :return: reply line, e.g. 'A:90', or None
+    """
     try:
-        ser = serial.Serial(SERIAL_PORT, BAUD_RATE, timeout=0)
-    except serial.serialutil.SerialException:
-        logging.debug('Serial port not found')
-        return
+        return get_read_subscription().get(timeout=timeout).line
+    except queue.Empty:
+        if not get_link().connected:
+            print('Serial port not found')
+        return None
+
+def write_serial_message(message):
+    """
+    Queue a message for the Arduino, never blocks (see SerialLink.send)
 
-    ser.close()
-    ser.open()
+    The link writes one message every MESSAGE_INTERVAL and keeps at most QUEUE_SIZE pending,
+    dropping the oldest ones, so callers sending in a loop must pace themselves or messages
+    are lost. set_angle and set_speed send the newest value of a channel instead.
 
-    ser.write(message)
-    time.sleep(0.2)
+    Replies not read yet are dropped, the next read_serial waits for the answer to this message.
+    """
+    subscription = get_read_subscription()
+    while True:
+        try:
+            subscription.get_nowait()
+        except queue.Empty:
+            break
 
-    ser.close()
+    get_link().send(message)
 
 
 def start_reader_thread():
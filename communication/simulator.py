@@ -0,0 +1,308 @@
+'''
+Arduino Master simulator on a pseudo-terminal
+
+Emulates how arduino_master.ino reads and answers the serial commands, so the
+serial code can be tested and benchmarked without hardware:
+    - bytes separated by less than 5 ms form one message, at most 4 bytes
+      (E:len otherwise), as in readSerialString
+    - the replies of processInput, including its quirks (E:# without '-' for
+      single characters, E:##- printed twice for unknown 2 character messages)
+    - the fault pin status line printed every loop and the heartbeat (optional)
+    - the emergency stop loop, printing STOP until 'r' is received
+    - the binary command frames of protocol.py (optional, the sketch does not decode them yet)
+    - the time the bytes take on the wire at the given baud rate (optional)
+
+usage: python3 simulator.py [baud_rate], then point SERIAL_PORT to the printed port
+'''
+
+import os
+import pty
+import select
+import sys
+import threading
+import time
+import tty
+
+try:
+    from . import protocol
+except ImportError:
+    import protocol
+
+BAUD_RATE = 9600
+
+# readSerialString waits this long after every byte, a gap this long ends the message
+BYTE_DELAY = 0.005
+
+# size of the message buffer of the sketch (MAX_SIZE), one byte is kept for the terminator
+MAX_SIZE = 5
+
+# bits on the wire per byte (start bit, 8 data bits, stop bit)
+BITS_PER_BYTE = 10
+
+HEARTBEAT_INTERVAL = 3.0
+
+# the sketch prints STOP and waits this long in a loop while the emergency stop is triggered
+STOP_INTERVAL = 1.0
+
+FAULT_MESSAGES = {
+    (1, 1): 'High High - Under voltage',
+    (1, 0): 'High LOW - Over temperature, overheating warning',
+    (0, 1): 'LOW HIGH - Short circuit',
+    (0, 0): 'LOW LOW - No fault',
+}
+
+# shortest loop period of the simulator when nothing throttles it
+LOOP_INTERVAL = 0.001
+
+
+def atoi(text):
+    """
+    C atoi: optional sign followed by digits, anything after them is ignored
+
+    :return: integer, 0 if text does not start with a number
+    """
+    text = text.lstrip()
+    end = 1 if text[:1] in ('+', '-') else 0
+    while end < len(text) and text[end].isdigit():
+        end += 1
+    try:
+        return int(text[:end])
+    except ValueError:
+        return 0
+
+
+def process_input(message, firmware, fault_flag='00'):
+    """
+    Replies of processInput in arduino_master.ino
+
+    :param message: message as returned by readSerialString
+    :param firmware: protocol.ReferenceFirmware holding the state of the car
+    :param fault_flag: fault pin status reported by Arduino Slave 0
+    :return: list of reply lines
+    """
+    length = len(message)
+
+    if length == 0:
+        return []
+    if length > 4:
+        return ['E:%s-' % message]
+
+    if length == 1:
+        if message == 'r':
+            firmware.estop_triggered = False
+            return ['R']
+        return ['E:%s' % message]
+
+    replies = []
+    value = atoi(message[1:])
+
+    if length == 2:
+        if message == 'ma':
+            firmware.mode = protocol.MODE_AUTO
+            return ['M:auto']
+        if message == 'mm':
+            firmware.mode = protocol.MODE_MANUAL
+            return ['M:man']
+        if message == 'ff':
+            return ['Getting fault flag', 'F:%s' % fault_flag]
+        if message[0] not in ('m', 'a', 's'):
+            # no return in the sketch, it falls through to the error below
+            replies.append('E:%s-' % message)
+
+    if message[0] == 'a':
+        firmware.angle = value
+        replies.append('A:%d' % value)
+    elif message[0] == 's':
+        firmware.speed = value
+        replies.append('S:%d' % value)
+    else:
+        replies.append('E:%s-' % message)
+
+    return replies
+
+
+class ArduinoSimulator:
+    """
+    Arduino Master answering on the slave side of a pseudo-terminal
+
+    Open port (the slave device path) like the real serial port. A background thread runs
+    the loop of the sketch until close() is called.
+    """
+    def __init__(self, baud_rate=BAUD_RATE, throttle=True, byte_delay=BYTE_DELAY, fault_pins=(0, 0),
+                 fault_messages=False, heartbeat=False, binary=False):
+        """
+        :param baud_rate: baud rate used to throttle the traffic
+        :param throttle: if True, bytes take as long as on the wire at baud_rate, both ways
+        :param byte_delay: wait after every received byte, a gap this long ends a message
+        :param fault_pins: state of the fault pins, see FAULT_MESSAGES
+        :param fault_messages: if True, the fault pin status is printed every loop like the sketch does
+        :param heartbeat: if True, HB:<seconds> is printed every HEARTBEAT_INTERVAL
+        :param binary: if True, binary command frames are decoded and acknowledged, otherwise they are
+                       read as text like arduino_master.ino does (E:len)
+        """
+        self.byte_time = BITS_PER_BYTE / baud_rate if throttle else 0.
+        self.byte_delay = byte_delay
+        self.fault_pins = tuple(fault_pins)
+        self.fault_messages = fault_messages
+        self.heartbeat = heartbeat
+        self.binary = binary
+
+        self.firmware = protocol.ReferenceFirmware()
+
+        # every message processed and the replies sent, for the tests
+        self.received = []
+        self.sent = []
+
+        self._master, self._slave = pty.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+
+        self._input = bytearray()
+        # time at which the last byte written will have left the simulated UART
+        self._wire_free = 0.
+        self._start = time.monotonic()
+        self._stopped = threading.Event()
+
+        self._thread = threading.Thread(target=self._run, name='arduino-simulator', daemon=True)
+        self._thread.start()
+
+    def trigger_estop(self):
+        """
+        Emergency stop, as the interrupt of the sketch: the car stops until 'r' is received
+        """
+        self.firmware.speed = 0
+        self.firmware.angle = 0
+        self.firmware.estop_triggered = True
+
+    def close(self):
+        self._stopped.set()
+        self._thread.join()
+        os.close(self._master)
+        os.close(self._slave)
+
+    def millis(self):
+        return int(1000 * (time.monotonic() - self._start))
+
+    def _receive(self, timeout):
+        """
+        Wait up to timeout for bytes from the computer, each taking byte_time to arrive
+
+        :return: True if at least one byte is available
+        """
+        if not self._input:
+            ready, _, _ = select.select([self._master], [], [], timeout)
+            if ready:
+                try:
+                    self._input += os.read(self._master, 1024)
+                except OSError:
+                    return False
+        return bool(self._input)
+
+    def _read_byte(self):
+        time.sleep(self.byte_time)
+        byte = self._input[0]
+        del self._input[:1]
+        return byte
+
+    def _write(self, data):
+        """
+        Write like Serial.print, the bytes reach the computer once they went over the wire
+        """
+        self._wire_free = max(self._wire_free, time.monotonic()) + len(data) * self.byte_time
+        delay = self._wire_free - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+        try:
+            os.write(self._master, data)
+        except OSError:
+            pass
+
+    def _println(self, line):
+        self.sent.append(line)
+        self._write(line.encode('ascii', errors='replace') + b'\r\n')
+
+    def _read_serial_string(self, timeout):
+        """
+        readSerialString of the sketch
+
+        :return: message, '' if nothing (or E:len) was received
+        """
+        if not self._receive(timeout):
+            return ''
+
+        message = bytearray()
+        # the sketch checks for more bytes right after its delay
+        while self._receive(0.):
+            if self.binary and not message and self._input[0] == protocol.COMMAND_SYNC:
+                self._read_frame()
+                return ''
+
+            byte = self._read_byte()
+            time.sleep(self.byte_delay)
+
+            if len(message) >= MAX_SIZE - 1:
+                self._println('E:len')
+                return ''
+            message.append(byte)
+
+        return message.decode('ascii', errors='replace')
+
+    def _read_frame(self):
+        """
+        Binary command frame: read as it arrives, without the message length limit
+        """
+        frame = bytearray()
+        while len(frame) < protocol.COMMAND_SIZE and self._receive(self.byte_delay):
+            frame.append(self._read_byte())
+
+        self.received.append(bytes(frame))
+        ack = self.firmware.receive(bytes(frame))
+        if ack:
+            self.sent.append(ack)
+            self._write(ack)
+
+    def _run(self):
+        last_heartbeat = time.monotonic()
+
+        while not self._stopped.is_set():
+            if self.firmware.estop_triggered:
+                self._println('STOP')
+                if self._read_serial_string(0.) == 'r':
+                    self._println('RESET')
+                    self.firmware.estop_triggered = False
+                self._stopped.wait(STOP_INTERVAL)
+                continue
+
+            now = time.monotonic()
+
+            # idle until a command arrives, unless the loop has something to print
+            timeout = LOOP_INTERVAL if self.fault_messages or self.heartbeat else 0.1
+            message = self._read_serial_string(timeout)
+            if message:
+                self.received.append(message)
+                for line in process_input(message, self.firmware, '%d%d' % self.fault_pins):
+                    self._println(line)
+
+            if self.fault_messages:
+                self._println(FAULT_MESSAGES[self.fault_pins])
+
+            if self.heartbeat and now - last_heartbeat >= HEARTBEAT_INTERVAL:
+                self._println('HB:%d' % (self.millis() // 1000))
+                last_heartbeat = now
+
+
+def main():
+    baud_rate = int(sys.argv[1]) if len(sys.argv) > 1 else BAUD_RATE
+
+    simulator = ArduinoSimulator(baud_rate=baud_rate, fault_messages=True, heartbeat=True)
+    print('Arduino simulator on %s, set SERIAL_PORT=%s' % (simulator.port, simulator.port))
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        simulator.close()
+
+if __name__ == '__main__':
+    main()
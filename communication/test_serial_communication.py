@@ -1,9 +1,41 @@
+'''
+Tests of the serial communication with the Arduino Master
+
+usage: python3 test_serial_communication.py [--simulate] [--fuzz] [--benchmark]
+   or: python3 -m communication.test_serial_communication [...] from the repository root
+
+--simulate  run against simulator.py instead of the Arduino on SERIAL_PORT
+--fuzz      send random messages and corrupted binary frames, check the Arduino keeps answering
+--benchmark measure the latency and throughput of the ASCII and binary protocols
+
+The binary frames are only decoded by the simulator, arduino_master.ino does not support them yet.
+
+The exit status is 1 if any check failed.
+'''
+
+import queue
+import random
+import statistics
+import sys
 import time
-import serial_communication
+
+try:
+    from . import protocol, serial_communication, simulator as arduino_simulator
+except ImportError:
+    import protocol
+    import serial_communication
+    import simulator as arduino_simulator
 
 NUM_ATTEMPTS = 5
 
-def test(command, expected):
+FUZZ_MESSAGES = 200
+FUZZ_FRAMES = 200
+FUZZ_ALPHABET = 'asmrf0123456789-x '
+
+BENCHMARK_COMMANDS = 50
+BENCHMARK_DURATION = 5.0
+
+def check(command, expected):
     print('Testing: %s -> %s' % (command, expected))
     serial_communication.write_serial_message(command)
     for i in range(NUM_ATTEMPTS):
@@ -11,38 +43,247 @@ def test(command, expected):
         print('\tAttempt %d: %s' % (i, result), end='')
         if result == expected:
             print('\r\t\t\t\t\t\tPASS')
-            return
+            return True
         else:
             print()
     print('\r\t\t\t\t\t\tFAIL')
+    return False
+
+def drain():
+    """
+    Wait until the Arduino stops replying, dropping the replies
+
+    write_serial_message already drops the replies received before it, this also waits for
+    the ones still on their way, e.g. the second reply of a message split by E:len.
+    """
+    while serial_communication.read_serial(timeout=0.1) is not None:
+        pass
+
+def run_protocol_tests():
+    """
+    :return: True if every check passed
+    """
+    results = []
+
+    results.append(check('a1', 'A:1'))
+    results.append(check('a12', 'A:12'))
+    results.append(check('a123', 'A:123'))
+
+    results.append(check('s1', 'S:1'))
+    results.append(check('s12', 'S:12'))
+    results.append(check('s123', 'S:123'))
+
+    results.append(check('mm', 'M:man'))
+    results.append(check('ma', 'M:auto'))
+
+    # single characters other than r are echoed without '-' (processInput in arduino_master.ino)
+    results.append(check('t', 'E:t'))
+    results.append(check('12345', 'E:len'))
+    results.append(check('1', 'E:1'))
+    results.append(check('m', 'E:m'))
+    results.append(check('mq', 'E:mq-'))
+
+    for i in range(16):
+        results.append(check('a123', 'A:123'))
+
+    return all(results)
+
+def fuzz_messages(count=FUZZ_MESSAGES, seed=0):
+    """
+    Random text messages, each followed by a valid command that must still be answered
+
+    A message longer than 4 bytes is cut after E:len and its remaining bytes are read as a new
+    message, which merges with a command arriving within 5 ms (the Arduino does the same). The
+    command is therefore only sent once the Arduino is done with the random message, i.e. once
+    its replies have stopped coming.
+    """
+    rng = random.Random(seed)
+    lost = 0
+
+    for i in range(count):
+        message = ''.join(rng.choice(FUZZ_ALPHABET) for _ in range(rng.randint(1, 6)))
+        serial_communication.write_serial_message(message)
+        drain()
+
+        angle = rng.randint(0, 180)
+        serial_communication.write_serial_message('a%d' % angle)
+
+        expected = 'A:%d' % angle
+        for _ in range(NUM_ATTEMPTS):
+            if serial_communication.read_serial() == expected:
+                break
+        else:
+            lost += 1
+            print('\tno reply to a%d after %r' % (angle, message))
+        drain()
+
+    print('fuzz messages: %d sent, %d lost' % (count, lost))
+    return lost == 0
+
+def fuzz_frames(count=FUZZ_FRAMES, seed=0):
+    """
+    Binary frames with random bit flips and junk bytes, only the intact ones must be acknowledged
+    """
+    rng = random.Random(seed)
+    link = serial_communication.get_link()
+    acks = serial_communication.get_reader().subscribe(['ack'], maxsize=count)
+
+    intact = set()
+    for seq in range(count):
+        frame = bytearray(protocol.encode_command(seq, rng.randint(0, 180), rng.randint(0, 255)))
+        if rng.random() < 0.2:
+            frame[rng.randrange(len(frame))] ^= 1 << rng.randrange(8)
+        else:
+            intact.add(seq)
+        if rng.random() < 0.1:
+            frame += bytes(rng.randrange(256) for _ in range(rng.randint(1, 3)))
+
+        # the link drops its oldest messages when it falls behind
+        while link.pending():
+            time.sleep(0.001)
+        link.send(bytes(frame))
+
+    acknowledged = set()
+    deadline = time.monotonic() + 2 + count * serial_communication.MESSAGE_INTERVAL
+    while acknowledged != intact and time.monotonic() < deadline:
+        try:
+            acknowledged.add(acks.get(timeout=0.1).value.seq)
+        except queue.Empty:
+            pass
+    serial_communication.get_reader().unsubscribe(acks)
+
+    # junk bytes can complete a corrupted frame once in a while, but intact frames must never be lost
+    missing = intact - acknowledged
+    print('fuzz frames: %d intact, %d acknowledged, %d missing, %d unexpected'
+          % (len(intact), len(acknowledged & intact), len(missing), len(acknowledged - intact)))
+    return not missing
+
+def benchmark_latency(count=BENCHMARK_COMMANDS):
+    """
+    Time from sending a command to receiving its reply, for both protocols
+    """
+    reader = serial_communication.get_reader()
+    replies = reader.subscribe(['angle', 'ack'])
+
+    for name in ('ascii', 'binary'):
+        drain()
+        latencies = []
+        for i in range(count):
+            angle = 60 + i % 60
+            if name == 'ascii':
+                message = 'a%d' % angle
+            else:
+                message = protocol.encode_command(i, angle, 0)
+
+            start = time.monotonic()
+            serial_communication.write_serial_message(message)
+            try:
+                event = replies.get(timeout=serial_communication.READ_TIMEOUT)
+            except queue.Empty:
+                continue
+            latencies.append(1000 * (event.time - start))
+
+            # leave time for the Arduino to finish with the message
+            time.sleep(serial_communication.MESSAGE_INTERVAL)
+
+        if latencies:
+            latencies.sort()
+            print('latency %-6s: %d replies, median %.1f ms, 95%% %.1f ms, %d bytes per command'
+                  % (name, len(latencies), statistics.median(latencies),
+                     latencies[int(0.95 * (len(latencies) - 1))], len(message)))
+        else:
+            print('latency %-6s: no reply' % name)
+
+    reader.unsubscribe(replies)
+
+def benchmark_throughput(duration=BENCHMARK_DURATION):
+    """
+    Steering and speed updates reaching the Arduino per second through the schedulers
+    """
+    link = serial_communication.get_link()
+    reader = serial_communication.get_reader()
+
+    for scheduler_class in (serial_communication.CommandScheduler, serial_communication.BinaryCommandScheduler):
+        drain()
+        events = reader.subscribe(['angle', 'speed', 'ack'], maxsize=10000)
+        if scheduler_class is serial_communication.BinaryCommandScheduler:
+            scheduler = scheduler_class(link, reader, rate=1000, deadbands={})
+        else:
+            scheduler = scheduler_class(link, rate=1000, deadbands={})
+
+        start = time.monotonic()
+        i = 0
+        while time.monotonic() - start < duration:
+            scheduler.set('a', 60 + i % 60)
+            scheduler.set('s', i % 100)
+            i += 1
+            time.sleep(0.001)
+        scheduler.close()
+        time.sleep(2 * serial_communication.MESSAGE_INTERVAL)
+        reader.unsubscribe(events)
+
+        counts = {'angle': 0, 'speed': 0, 'ack': 0}
+        while not events.empty():
+            counts[events.get().kind] += 1
+
+        # an update is complete once both the angle and the speed are applied
+        updates = counts['ack'] if counts['ack'] else min(counts['angle'], counts['speed'])
+        print('throughput %-22s: %.1f updates/s' % (scheduler_class.__name__, updates / duration))
+
+def set_binary_frames(simulator, enabled):
+    """
+    Let the simulator decode binary frames, arduino_master.ino does not decode them yet so the
+    binary checks and benchmarks only pass against the simulator
+    """
+    if simulator is not None:
+        simulator.binary = enabled
 
 def main():
+    arguments = sys.argv[1:]
+
+    simulator = None
+    if '--simulate' in arguments:
+        simulator = arduino_simulator.ArduinoSimulator()
+        serial_communication.SERIAL_PORT = simulator.port
+        serial_communication.RESET_DELAY = 0
+        print('Simulated Arduino on %s' % simulator.port)
+
     serial_communication.write_serial_message('')
 
-    for i in range(3, 0, -1):
-        print('\r' + str(i), end='')
-        time.sleep(1)
-    print('\r', end='')
+    if simulator is None:
+        for i in range(3, 0, -1):
+            print('\r' + str(i), end='')
+            time.sleep(1)
+        print('\r', end='')
+    else:
+        serial_communication.get_link().wait_connected()
 
-    test('a1', 'A:1')
-    test('a12', 'A:12')
-    test('a123', 'A:123')
+    passed = run_protocol_tests()
 
-    test('s1', 'S:1')
-    test('s12', 'S:12')
-    test('s123', 'S:123')
+    if '--fuzz' in arguments:
+        drain()
+        passed = fuzz_messages() and passed
 
-    test('mm', 'M:man')
-    test('ma', 'M:auto')
+        if simulator is not None:
+            set_binary_frames(simulator, True)
+            passed = fuzz_frames() and passed
+            set_binary_frames(simulator, False)
+        else:
+            print('fuzz frames: skipped, arduino_master.ino does not decode binary frames')
 
-    test('t', 'E:t-')
-    test('12345', 'E:len')
-    test('1', 'E:1-')
-    test('m', 'E:m-')
-    test('mq', 'E:mq-')
+    if '--benchmark' in arguments:
+        # the text commands are measured with binary frames enabled too, they never start with a sync byte
+        set_binary_frames(simulator, True)
+        benchmark_latency()
+        benchmark_throughput()
+        set_binary_frames(simulator, False)
 
-    for i in range(16):
-        test('a123', 'A:123')
+    serial_communication.get_link().close()
+    if simulator is not None:
+        simulator.close()
+
+    print('PASS' if passed else 'FAIL')
+    sys.exit(0 if passed else 1)
 
 if __name__ == '__main__':
     main()
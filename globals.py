@@ -4,6 +4,4 @@ xm_per_pix = 3.7 / 700  # meters per pixel in x dimension
 
 time_window = 10        # results are averaged over this number of frames
 
-
-
-
+processing_scale = 1.0  # resolution of the segmentation stages relative to the camera frame (1, 0.5, 0.25 use pyrDown)
@@ -0,0 +1,58 @@
+'''
+Registry of cached perspective transforms
+
+Every perspective warp in the pipeline looks its matrices up here, so each
+(frame shape, src points, dst points) combination is only solved once. Only
+the most recently used combinations are kept, arbitrary points (e.g. from
+four_point_transform) cannot grow the registry without bound.
+'''
+
+import collections
+
+import cv2
+import numpy as np
+
+# number of (frame shape, src points, dst points) combinations kept
+homography_cache_size = 32
+
+# (frame shape, src bytes, dst bytes) -> (M, Minv), least recently used first
+_homographies = collections.OrderedDict()
+
+
+def get_perspective_transforms(frame_shape, src_pts, dst_pts):
+    """
+    Return the forward and inverse perspective transforms mapping src_pts onto dst_pts.
+
+    :param frame_shape: shape of the frame the transform is applied to
+    :param src_pts: four source points, (x, y) in pixels
+    :param dst_pts: four destination points, (x, y) in pixels
+    :return: read-only float32 matrices M and Minv, ready for cv2.warpPerspective
+    """
+    src = np.float32(src_pts).reshape(4, 2)
+    dst = np.float32(dst_pts).reshape(4, 2)
+
+    key = (tuple(frame_shape[:2]), src.tobytes(), dst.tobytes())
+    transforms = _homographies.get(key)
+
+    if transforms is not None:
+        _homographies.move_to_end(key)
+    else:
+        M = np.float32(cv2.getPerspectiveTransform(src, dst))
+        Minv = np.float32(cv2.getPerspectiveTransform(dst, src))
+        M.setflags(write=False)
+        Minv.setflags(write=False)
+
+        transforms = (M, Minv)
+        _homographies[key] = transforms
+
+        while len(_homographies) > homography_cache_size:
+            _homographies.popitem(last=False)
+
+    return transforms
+
+
+def clear_perspective_transforms():
+    """
+    Drop every cached transform.
+    """
+    _homographies.clear()
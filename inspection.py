@@ -16,9 +16,12 @@ start_time = time.time()
 
 serial_communication.write_serial_message('s20')
 
+# messages are queued without waiting, send them no faster than the link writes them
 while time.time() - start_time < runtime:
+    time.sleep(serial_communication.MESSAGE_INTERVAL)
     serial_communication.write_serial_message('a70')
     #time.sleep(0.1)
+    time.sleep(serial_communication.MESSAGE_INTERVAL)
     serial_communication.write_serial_message('a110')
     #time.sleep(0.1)
 
@@ -0,0 +1,324 @@
+'''
+Lane tracking with a Kalman filter over the lane-line polynomials
+
+Both lane-lines are modeled as parallel quadratics sharing their curvature
+and slope, x = A*yn^2 + B*yn + C -/+ W/2 with yn = y / frame height, so the
+state is [A, B, C, W] (all in pixels): shape, lane center at the top of the
+bird's eye view and lane width. Every frame:
+    - the state is predicted (random walk)
+    - lane pixels are searched in a corridor around the predicted lines, its
+      width following the predicted uncertainty
+    - the fits of both lines form a 6-dimensional measurement, accepted if its
+      Mahalanobis distance passes a chi-square gate
+    - otherwise a full sliding window search is run, and the filter restarts
+      from it if it still does not match the prediction
+'''
+
+import numpy as np
+
+import line_utils
+from line_utils import Line, LaneFitDiagnostics, get_band_pixels, scale_fit
+from polyfit_utils import fit_poly2, fit_to_meters
+from globals import time_window
+
+# 99% quantile of the chi-square distribution with 6 degrees of freedom
+INNOVATION_GATE = 16.81
+
+# maps the state [A, B, C, W] onto the measurement [A_lt, B_lt, C_lt, A_rt, B_rt, C_rt]
+MEASUREMENT_MATRIX = np.array([[1., 0., 0., 0.],
+                               [0., 1., 0., 0.],
+                               [0., 0., 1., -0.5],
+                               [1., 0., 0., 0.],
+                               [0., 1., 0., 0.],
+                               [0., 0., 1., 0.5]])
+
+
+class LaneTracker:
+    """
+    Kalman filter tracking both lane-lines, deciding where to search for them in every frame.
+    """
+    def __init__(self, buffer_len=time_window, process_noise=(10., 10., 5., 2.), measurement_noise=(30., 20., 10.),
+                 corridor_sigmas=3., min_margin=30, max_margin=100, min_pixels=50, max_spread=0.3, max_misses=5,
+                 confidence_sigma=20.):
+        """
+        :param buffer_len: history length of the tracked Line objects
+        :param process_noise: standard deviation of the per-frame change of A, B, C and W (pixels)
+        :param measurement_noise: standard deviation of the fitted A, B and C of a line (pixels)
+        :param corridor_sigmas: half width of the search corridor, in predicted standard deviations
+        :param min_margin: minimum half width of the search corridor (full resolution pixels)
+        :param max_margin: maximum half width of the search corridor (full resolution pixels)
+        :param min_pixels: minimum number of pixels for a line fit to count as a measurement
+        :param max_spread: maximum median distance of the pixels to their fit, relative to the search
+                           margin (pixels spread uniformly over the search area give about 0.5)
+        :param max_misses: frames without measurement after which the track is dropped
+        :param confidence_sigma: lane center uncertainty (pixels) at which the confidence is 0.5
+        """
+        self.Q = np.diag(np.square(process_noise))
+        self.R = np.diag(np.square(np.tile(measurement_noise, 2)))
+        self.corridor_sigmas = corridor_sigmas
+        self.min_margin = min_margin
+        self.max_margin = max_margin
+        self.min_pixels = min_pixels
+        self.max_spread = max_spread
+        self.max_misses = max_misses
+        self.confidence_sigma = confidence_sigma
+
+        # filtered lines, updated every frame like the ones of the search functions
+        self.line_lt = Line(buffer_len=buffer_len)
+        self.line_rt = Line(buffer_len=buffer_len)
+
+        # height of the bird's eye view at full resolution, known from the first frame
+        self.height = None
+
+        self.reset()
+
+    def reset(self):
+        """
+        Drop the track, the next frame is searched with sliding windows.
+        """
+        self.state = None
+        self.P = None
+        self.misses = 0
+
+        # outcome of the last frame
+        self.innovation_distance = None
+        self.search = None
+
+    @property
+    def initialized(self):
+        return self.state is not None
+
+    @property
+    def confidence(self):
+        """
+        Confidence in the tracked lane, from 1 (certain) to 0 (no track), based on the
+        uncertainty of the lane center at the bottom of the frame.
+        """
+        if not self.initialized:
+            return 0.
+        h = np.array([1., 1., 1., 0.])
+        sigma = np.sqrt(h.dot(self.P).dot(h))
+        return 1. / (1. + sigma / self.confidence_sigma)
+
+    def predict(self, frames=1):
+        """
+        Prediction step, can be called without update to skip frames that arrive too late.
+
+        :param frames: number of frames elapsed since the last prediction
+        """
+        if self.initialized:
+            self.P = self.P + frames * self.Q
+
+    def get_fits(self):
+        """
+        Pixel polynomial coefficients of both lines for the current state (full resolution).
+        """
+        A, B, C, W = self.state
+        h = self.height
+        return (np.array([A / h ** 2, B / h, C - W / 2]),
+                np.array([A / h ** 2, B / h, C + W / 2]))
+
+    def get_margin(self):
+        """
+        Half width of the search corridor (full resolution pixels), from the predicted
+        uncertainty of the line positions over the height of the frame.
+        """
+        variance = 0.
+        for yn in (0., 0.5, 1.):
+            for side in (-0.5, 0.5):
+                h = np.array([yn ** 2, yn, 1., side])
+                variance = max(variance, h.dot(self.P).dot(h))
+
+        margin = self.corridor_sigmas * np.sqrt(variance)
+        return int(np.clip(margin, self.min_margin, self.max_margin))
+
+    def to_measurement(self, fit_lt, fit_rt):
+        h = self.height
+        return np.array([fit_lt[0] * h ** 2, fit_lt[1] * h, fit_lt[2],
+                         fit_rt[0] * h ** 2, fit_rt[1] * h, fit_rt[2]])
+
+    def get_innovation(self, z):
+        """
+        :return: innovation, its covariance and squared Mahalanobis distance
+        """
+        innovation = z - MEASUREMENT_MATRIX.dot(self.state)
+        S = MEASUREMENT_MATRIX.dot(self.P).dot(MEASUREMENT_MATRIX.T) + self.R
+        return innovation, S, innovation.dot(np.linalg.solve(S, innovation))
+
+    def correct(self, z):
+        """
+        Kalman update with an accepted measurement.
+        """
+        innovation, S, _ = self.get_innovation(z)
+        K = np.linalg.solve(S, MEASUREMENT_MATRIX.dot(self.P)).T
+        self.state = self.state + K.dot(innovation)
+        self.P = (np.eye(4) - K.dot(MEASUREMENT_MATRIX)).dot(self.P)
+
+    def initialize(self, z):
+        """
+        Start a new track from a measurement.
+        """
+        a_lt, b_lt, c_lt, a_rt, b_rt, c_rt = z
+        self.state = np.array([(a_lt + a_rt) / 2, (b_lt + b_rt) / 2, (c_lt + c_rt) / 2, c_rt - c_lt])
+
+        # the shared curvature and slope are as uncertain as the fits they average
+        r = np.diag(self.R)
+        self.P = np.diag([r[0] / 2, r[1] / 2, r[2] / 2, 2 * r[2]])
+
+    def fit_pixels(self, pixels, margin, scale):
+        """
+        Fit a line to its pixels, if there are enough of them and they actually form a line
+        rather than clutter filling the search area.
+
+        :param pixels: y and x coordinates of the pixels (at the given scale)
+        :param margin: half width of the area the pixels were searched in (at the given scale)
+        :param scale: scale of the searched image relative to full resolution
+        :return: full resolution pixel fit, or None
+        """
+        y, x = pixels
+        if len(x) < self.min_pixels * scale ** 2:
+            return None
+
+        fit = fit_poly2(x, y, y_scale=self.height * scale)
+        # the median ignores clutter around a line, as long as most pixels belong to the line
+        spread = np.median(np.abs(x - np.polyval(fit, y)))
+        if spread > self.max_spread * margin:
+            return None
+
+        return scale_fit(fit, 1. / scale)
+
+    def search_corridor(self, birdeye_binary, scale):
+        margin = int(self.get_margin() * scale)
+        fit_lt, fit_rt = self.get_fits()
+
+        left_pixels = get_band_pixels(birdeye_binary, scale_fit(fit_lt, scale), margin)
+        right_pixels = get_band_pixels(birdeye_binary, scale_fit(fit_rt, scale), margin)
+
+        return LaneFitDiagnostics(False, left_pixels, right_pixels, None, margin, scale)
+
+    def search_windows(self, birdeye_binary, scale):
+        _, _, diagnostics = line_utils.fit_by_sliding_windows(birdeye_binary, Line(buffer_len=1), Line(buffer_len=1),
+                                                              n_windows=9, scale=scale)
+        return diagnostics
+
+    def update(self, birdeye_binary, scale=1.0):
+        """
+        Track the lane-lines in a new bird's eye view binary frame.
+
+        :param birdeye_binary: input bird's eye view binary image
+        :param scale: scale of birdeye_binary relative to full resolution
+        :return: filtered left and right lane-lines, LaneFitDiagnostics of the search that was used
+        """
+        self.height = birdeye_binary.shape[0] / scale
+        self.predict()
+
+        z = None
+        diagnostics = None
+
+        # narrow search around the prediction first
+        if self.initialized:
+            diagnostics = self.search_corridor(birdeye_binary, scale)
+            fits = [self.fit_pixels(pixels, diagnostics.margin, scale)
+                    for pixels in (diagnostics.left_pixels, diagnostics.right_pixels)]
+
+            if fits[0] is not None and fits[1] is not None:
+                z = self.to_measurement(*fits)
+                _, _, self.innovation_distance = self.get_innovation(z)
+
+                if self.innovation_distance <= INNOVATION_GATE:
+                    self.correct(z)
+                    self.search = 'corridor'
+                else:
+                    z = None
+
+        # full search when the corridor search failed
+        if z is None:
+            diagnostics = self.search_windows(birdeye_binary, scale)
+            fits = [self.fit_pixels(pixels, diagnostics.margin, scale)
+                    for pixels in (diagnostics.left_pixels, diagnostics.right_pixels)]
+
+            if fits[0] is not None and fits[1] is not None:
+                z = self.to_measurement(*fits)
+                self.search = 'windows'
+
+                if self.initialized:
+                    _, _, self.innovation_distance = self.get_innovation(z)
+
+                if self.initialized and self.innovation_distance <= INNOVATION_GATE:
+                    self.correct(z)
+                else:
+                    # the lane changed more than the filter can explain, start over from the measurement
+                    self.initialize(z)
+                    self.innovation_distance = 0.
+
+        detected = z is not None
+        if detected:
+            self.misses = 0
+        else:
+            self.misses += 1
+            self.search = None
+            if self.misses > self.max_misses:
+                self.reset()
+
+        self.update_lines(diagnostics, detected)
+
+        return self.line_lt, self.line_rt, diagnostics._replace(detected=detected)
+
+    def update_lines(self, diagnostics, detected):
+        """
+        Publish the filtered state through the Line objects.
+        """
+        for line, (y, x) in ((self.line_lt, diagnostics.left_pixels), (self.line_rt, diagnostics.right_pixels)):
+            line.all_x, line.all_y = x / diagnostics.scale, y / diagnostics.scale
+
+        if self.initialized:
+            for line, fit_pixel in zip((self.line_lt, self.line_rt), self.get_fits()):
+                line.update_line(fit_pixel, fit_to_meters(fit_pixel), detected=detected)
+        else:
+            self.line_lt.detected = self.line_rt.detected = False
+
+    def skip(self, frames=1):
+        """
+        Account for frames that were dropped without processing.
+        """
+        self.predict(frames)
+
+
+def check_noisy_mask(noise=0.03, frames=20, shape=(720, 1280), seed=0):
+    """
+    Track two straight lane-lines on a bird's eye view mask with salt noise.
+
+    :param noise: fraction of the pixels set at random
+    :param frames: number of frames tracked
+    :param shape: mask height and width
+    :param seed: seed of the noise
+    :return: True if the lines were detected in every frame, near their true position
+    """
+    rng = np.random.default_rng(seed)
+    height, width = shape
+    centers = (width // 3, 2 * width // 3)
+
+    tracker = LaneTracker()
+    detected = 0
+
+    for _ in range(frames):
+        mask = (rng.random(shape) < noise).astype(np.uint8)
+        for center in centers:
+            mask[:, center - 6:center + 7] = 1
+
+        line_lt, line_rt, diagnostics = tracker.update(mask)
+        if not diagnostics.detected:
+            continue
+
+        bottoms = [np.polyval(line.last_fit_pixel, height - 1) for line in (line_lt, line_rt)]
+        if np.allclose(bottoms, centers, atol=10):
+            detected += 1
+
+    print('noise %.2f: lines detected in %d/%d frames' % (noise, detected, frames))
+
+    return detected == frames
+
+
+if __name__ == '__main__':
+
+    assert check_noisy_mask()
@@ -6,13 +6,79 @@ import matplotlib.pyplot as plt
 from calibration_utils import calibrate_camera, undistort
 from binarization_utils import binarize
 from perspective_utils import birdeye
-from globals import ym_per_pix, xm_per_pix
+from polyfit_utils import fit_poly2, fit_to_meters
+from globals import xm_per_pix
+
+
+class FitHistory:
+    """
+    Fixed-size history of polynomial coefficients with a running sum.
+
+    Entries are written twice into a buffer of twice the capacity, so the last N entries
+    are always a contiguous slice and can be exposed as a view, oldest first.
+    """
+    __slots__ = ('capacity', 'buffer', 'sum', 'position', 'count')
+
+    def __init__(self, capacity, n_coeffs=3):
+        self.capacity = capacity
+        self.buffer = np.zeros((2 * capacity, n_coeffs))
+        self.sum = np.zeros(n_coeffs)
+        self.position = 0
+        self.count = 0
+
+    def clear(self):
+        self.sum[:] = 0
+        self.position = 0
+        self.count = 0
+
+    def append(self, coeffs):
+        if self.count == self.capacity:
+            self.sum -= self.buffer[self.position]
+        else:
+            self.count += 1
+
+        self.buffer[self.position] = coeffs
+        self.buffer[self.position + self.capacity] = coeffs
+        self.sum += self.buffer[self.position]
+
+        self.position = (self.position + 1) % self.capacity
+
+        # start over from the stored values once per cycle so rounding errors do not build up
+        if self.position == 0:
+            self.sum[:] = self.view().sum(axis=0)
+
+    def view(self):
+        """
+        Read-only view of the stored entries, oldest first.
+        """
+        start = self.position + self.capacity - self.count
+        history = self.buffer[start:start + self.count]
+        history.flags.writeable = False
+        return history
+
+    def mean(self):
+        if self.count == 0:
+            return np.full(self.sum.shape, np.nan)
+        return self.sum / self.count
+
+    def __len__(self):
+        return self.count
+
+
+def get_curvature(coeffs, y_eval=0):
+    """
+    Radius of curvature of x = f(y) at y_eval.
+    """
+    return ((1 + (2 * coeffs[0] * y_eval + coeffs[1]) ** 2) ** 1.5) / np.absolute(2 * coeffs[0])
 
 
 class Line:
     """
     Class to model a lane-line.
     """
+    __slots__ = ('detected', 'last_fit_pixel', 'last_fit_meter', 'history_pixel', 'history_meter',
+                 'radius_of_curvature', 'all_x', 'all_y')
+
     def __init__(self, buffer_len=10):
 
         # flag to mark if the line was detected the last iteration
@@ -22,9 +88,9 @@ class Line:
         self.last_fit_pixel = None
         self.last_fit_meter = None
 
-        # list of polynomial coefficients of the last N iterations
-        self.recent_fits_pixel = collections.deque(maxlen=buffer_len)
-        self.recent_fits_meter = collections.deque(maxlen=2 * buffer_len)
+        # polynomial coefficients of the last N iterations
+        self.history_pixel = FitHistory(buffer_len)
+        self.history_meter = FitHistory(2 * buffer_len)
 
         self.radius_of_curvature = None
 
@@ -45,14 +111,17 @@ class Line:
         self.detected = detected
 
         if clear_buffer:
-            self.recent_fits_pixel = []
-            self.recent_fits_meter = []
+            self.history_pixel.clear()
+            self.history_meter.clear()
 
         self.last_fit_pixel = new_fit_pixel
         self.last_fit_meter = new_fit_meter
 
-        self.recent_fits_pixel.append(self.last_fit_pixel)
-        self.recent_fits_meter.append(self.last_fit_meter)
+        # nothing to remember when no line has been found yet
+        if new_fit_pixel is not None:
+            self.history_pixel.append(new_fit_pixel)
+        if new_fit_meter is not None:
+            self.history_meter.append(new_fit_meter)
 
     def draw(self, mask, color=(255, 0, 0), line_width=50, average=False):
         """
@@ -75,45 +144,120 @@ class Line:
         # Draw the lane onto the warped blank image
         return cv2.fillPoly(mask, [np.int32(pts)], color)
 
+    @property
+    # polynomial coefficients of the last N iterations, oldest first (read-only view)
+    def recent_fits_pixel(self):
+        return self.history_pixel.view()
+
+    @property
+    # polynomial coefficients in meters of the last 2N iterations, oldest first (read-only view)
+    def recent_fits_meter(self):
+        return self.history_meter.view()
+
     @property
     # average of polynomial coefficients of the last N iterations
     def average_fit(self):
-        return np.mean(self.recent_fits_pixel, axis=0)
+        return self.history_pixel.mean()
 
     @property
     # radius of curvature of the line (averaged)
     def curvature(self):
-        y_eval = 0
-        coeffs = self.average_fit
-        return ((1 + (2 * coeffs[0] * y_eval + coeffs[1]) ** 2) ** 1.5) / np.absolute(2 * coeffs[0])
+        return get_curvature(self.history_pixel.mean())
 
     @property
     # radius of curvature of the line (averaged)
     def curvature_meter(self):
-        y_eval = 0
-        coeffs = np.mean(self.recent_fits_meter, axis=0)
-        return ((1 + (2 * coeffs[0] * y_eval + coeffs[1]) ** 2) ** 1.5) / np.absolute(2 * coeffs[0])
+        return get_curvature(self.history_meter.mean())
 
 
-def get_fits_by_sliding_windows(birdeye_binary, line_lt, line_rt, n_windows=9, verbose=False):
+def scale_fit(fit, scale):
     """
-    Get polynomial coefficients for lane-lines detected in an binary image.
+    Express a polynomial x = f(y) fitted at full resolution in the coordinates of an image scaled by scale.
+
+    :param fit: polynomial coefficients (pixel)
+    :param scale: image scale relative to full resolution, use 1 / scale to map back
+    :return: scaled polynomial coefficients
+    """
+    return np.array([fit[0] / scale, fit[1], fit[2] * scale])
+
+
+# Outcome of a lane search, enough to render it afterwards. Pixels are (y, x) arrays at the
+# scale of the searched image, windows are the sliding window rectangles ((x1, y1), (x2, y2)),
+# or None for the search around previous fits.
+LaneFitDiagnostics = collections.namedtuple('LaneFitDiagnostics', ['detected', 'left_pixels', 'right_pixels',
+                                                                   'windows', 'margin', 'scale'])
+
+
+def update_fits(line_lt, line_rt, left_pixels, right_pixels, height, scale):
+    """
+    Fit both lane-lines to their pixels and update them.
+
+    A line without pixels keeps its last fit and both lines are marked as not detected.
+
+    :param line_lt: left lane-line
+    :param line_rt: right lane-line
+    :param left_pixels: y and x coordinates of the left line pixels (at the given scale)
+    :param right_pixels: y and x coordinates of the right line pixels (at the given scale)
+    :param height: height of the searched image
+    :param scale: scale of the searched image relative to full resolution
+    :return: True if both lines were detected
+    """
+    detected = True
+    fits = []
+
+    for line, (y, x) in ((line_lt, left_pixels), (line_rt, right_pixels)):
+        # Extract line pixel positions (in full resolution pixels)
+        line.all_x, line.all_y = x / scale, y / scale
+
+        if len(x) == 0:
+            fits.append((line.last_fit_pixel, line.last_fit_meter))
+            detected = False
+        else:
+            fit_pixel = fit_poly2(line.all_x, line.all_y, y_scale=height / scale)
+            fits.append((fit_pixel, fit_to_meters(fit_pixel)))
+
+    for line, (fit_pixel, fit_meter) in zip((line_lt, line_rt), fits):
+        line.update_line(fit_pixel, fit_meter, detected=detected)
+
+    return detected
+
+
+def get_fit_curves(line_lt, line_rt, height, scale):
+    """
+    Generate x and y values for plotting the last fits (at the scale of the searched image).
+
+    :return: ploty, left_fitx, right_fitx (None for a line that was never fitted)
+    """
+    ploty = np.linspace(0, height - 1, height)
+    curves = []
+
+    for line in (line_lt, line_rt):
+        if line.last_fit_pixel is None:
+            curves.append(None)
+        else:
+            fit_pixel = scale_fit(line.last_fit_pixel, scale)
+            curves.append(fit_pixel[0] * ploty ** 2 + fit_pixel[1] * ploty + fit_pixel[2])
+
+    return ploty, curves[0], curves[1]
+
+
+def fit_by_sliding_windows(birdeye_binary, line_lt, line_rt, n_windows=9, scale=1.0):
+    """
+    Get polynomial coefficients for lane-lines detected in an binary image, without rendering anything.
 
     :param birdeye_binary: input bird's eye view binary image
     :param line_lt: left lane-line previously detected
     :param line_rt: left lane-line previously detected
     :param n_windows: number of sliding windows used to search for the lines
-    :param verbose: if True, display intermediate output
-    :return: updated lane lines and output image
+    :param scale: scale of birdeye_binary relative to full resolution; pixels and fits are
+                  mapped back so lines are always expressed in full resolution pixels
+    :return: updated lane lines and LaneFitDiagnostics
     """
     height, width = birdeye_binary.shape
 
     # Assuming you have created a warped binary image called "binary_warped"
     # Take a histogram of the bottom half of the image
-    histogram = np.sum(birdeye_binary[height//2:-30, :], axis=0)
-
-    # Create an output image to draw on and  visualize the result
-    out_img = np.dstack((birdeye_binary, birdeye_binary, birdeye_binary)) * 255
+    histogram = np.sum(birdeye_binary[height//2:height - int(30 * scale), :], axis=0)
 
     # Find the peak of the left and right halves of the histogram
     # These will be the starting point for the left and right lines
@@ -122,23 +266,29 @@ def get_fits_by_sliding_windows(birdeye_binary, line_lt, line_rt, n_windows=9, v
     rightx_base = np.argmax(histogram[midpoint:]) + midpoint
 
     # Set height of windows
-    window_height = np.int(height / n_windows)
+    window_height = int(height / n_windows)
 
     # Identify the x and y positions of all nonzero pixels in the image
+    # (nonzero() scans row by row, so nonzero_y is sorted)
     nonzero = birdeye_binary.nonzero()
     nonzero_y = np.array(nonzero[0])
     nonzero_x = np.array(nonzero[1])
 
+    # Index range of the pixels of every window row band, the bottom band first
+    band_edges = height - np.arange(n_windows + 1) * window_height
+    band_bounds = np.searchsorted(nonzero_y, band_edges)
+
     # Current positions to be updated for each window
     leftx_current = leftx_base
     rightx_current = rightx_base
 
-    margin = 100  # width of the windows +/- margin
-    minpix = 50   # minimum number of pixels found to recenter window
+    margin = int(100 * scale)       # width of the windows +/- margin
+    minpix = int(50 * scale ** 2)   # minimum number of pixels found to recenter window
 
     # Create empty lists to receive left and right lane pixel indices
     left_lane_inds = []
     right_lane_inds = []
+    windows = []
 
     # Step through the windows one by one
     for window in range(n_windows):
@@ -150,15 +300,16 @@ def get_fits_by_sliding_windows(birdeye_binary, line_lt, line_rt, n_windows=9, v
         win_xright_low = rightx_current - margin
         win_xright_high = rightx_current + margin
 
-        # Draw the windows on the visualization image
-        cv2.rectangle(out_img, (win_xleft_low, win_y_low), (win_xleft_high, win_y_high), (0, 255, 0), 2)
-        cv2.rectangle(out_img, (win_xright_low, win_y_low), (win_xright_high, win_y_high), (0, 255, 0), 2)
+        # Remember the windows for the visualization
+        windows.append(((win_xleft_low, win_y_low), (win_xleft_high, win_y_high)))
+        windows.append(((win_xright_low, win_y_low), (win_xright_high, win_y_high)))
+
+        # Identify the nonzero pixels in x and y within the window, only looking at its row band
+        band_start, band_stop = band_bounds[window + 1], band_bounds[window]
+        band_x = nonzero_x[band_start:band_stop]
 
-        # Identify the nonzero pixels in x and y within the window
-        good_left_inds = ((nonzero_y >= win_y_low) & (nonzero_y < win_y_high) & (nonzero_x >= win_xleft_low)
-                          & (nonzero_x < win_xleft_high)).nonzero()[0]
-        good_right_inds = ((nonzero_y >= win_y_low) & (nonzero_y < win_y_high) & (nonzero_x >= win_xright_low)
-                           & (nonzero_x < win_xright_high)).nonzero()[0]
+        good_left_inds = band_start + ((band_x >= win_xleft_low) & (band_x < win_xleft_high)).nonzero()[0]
+        good_right_inds = band_start + ((band_x >= win_xright_low) & (band_x < win_xright_high)).nonzero()[0]
 
         # Append these indices to the lists
         left_lane_inds.append(good_left_inds)
@@ -166,152 +317,246 @@ def get_fits_by_sliding_windows(birdeye_binary, line_lt, line_rt, n_windows=9, v
 
         # If you found > minpix pixels, recenter next window on their mean position
         if len(good_left_inds) > minpix:
-            leftx_current = np.int(np.mean(nonzero_x[good_left_inds]))
+            leftx_current = int(np.mean(nonzero_x[good_left_inds]))
         if len(good_right_inds) > minpix:
-            rightx_current = np.int(np.mean(nonzero_x[good_right_inds]))
+            rightx_current = int(np.mean(nonzero_x[good_right_inds]))
 
     # Concatenate the arrays of indices
     left_lane_inds = np.concatenate(left_lane_inds)
     right_lane_inds = np.concatenate(right_lane_inds)
 
-    # Extract left and right line pixel positions
-    line_lt.all_x, line_lt.all_y = nonzero_x[left_lane_inds], nonzero_y[left_lane_inds]
-    line_rt.all_x, line_rt.all_y = nonzero_x[right_lane_inds], nonzero_y[right_lane_inds]
+    left_pixels = (nonzero_y[left_lane_inds], nonzero_x[left_lane_inds])
+    right_pixels = (nonzero_y[right_lane_inds], nonzero_x[right_lane_inds])
 
-    detected = True
-    if not list(line_lt.all_x) or not list(line_lt.all_y):
-        left_fit_pixel = line_lt.last_fit_pixel
-        left_fit_meter = line_lt.last_fit_meter
-        detected = False
-    else:
-        left_fit_pixel = np.polyfit(line_lt.all_y, line_lt.all_x, 2)
-        left_fit_meter = np.polyfit(line_lt.all_y * ym_per_pix, line_lt.all_x * xm_per_pix, 2)
+    detected = update_fits(line_lt, line_rt, left_pixels, right_pixels, height, scale)
 
-    if not list(line_rt.all_x) or not list(line_rt.all_y):
-        right_fit_pixel = line_rt.last_fit_pixel
-        right_fit_meter = line_rt.last_fit_meter
-        detected = False
-    else:
-        right_fit_pixel = np.polyfit(line_rt.all_y, line_rt.all_x, 2)
-        right_fit_meter = np.polyfit(line_rt.all_y * ym_per_pix, line_rt.all_x * xm_per_pix, 2)
+    return line_lt, line_rt, LaneFitDiagnostics(detected, left_pixels, right_pixels, windows, margin, scale)
 
-    line_lt.update_line(left_fit_pixel, left_fit_meter, detected=detected)
-    line_rt.update_line(right_fit_pixel, right_fit_meter, detected=detected)
 
-    # Generate x and y values for plotting
-    ploty = np.linspace(0, height - 1, height)
-    left_fitx = left_fit_pixel[0] * ploty ** 2 + left_fit_pixel[1] * ploty + left_fit_pixel[2]
-    right_fitx = right_fit_pixel[0] * ploty ** 2 + right_fit_pixel[1] * ploty + right_fit_pixel[2]
+def render_sliding_windows(birdeye_binary, line_lt, line_rt, diagnostics, verbose=False):
+    """
+    Draw the outcome of fit_by_sliding_windows.
+
+    :param birdeye_binary: the searched bird's eye view binary image
+    :param line_lt: left lane-line, as updated by the search
+    :param line_rt: right lane-line, as updated by the search
+    :param diagnostics: LaneFitDiagnostics returned by the search
+    :param verbose: if True, display the output
+    :return: output image (at the scale of birdeye_binary)
+    """
+    height, width = birdeye_binary.shape
 
-    out_img[nonzero_y[left_lane_inds], nonzero_x[left_lane_inds]] = [255, 0, 0]
-    out_img[nonzero_y[right_lane_inds], nonzero_x[right_lane_inds]] = [0, 0, 255]
+    # Create an output image to draw on and  visualize the result
+    out_img = np.dstack((birdeye_binary, birdeye_binary, birdeye_binary)) * 255
+
+    # Draw the windows on the visualization image
+    for top_left, bottom_right in diagnostics.windows:
+        cv2.rectangle(out_img, top_left, bottom_right, (0, 255, 0), 2)
+
+    out_img[diagnostics.left_pixels] = [255, 0, 0]
+    out_img[diagnostics.right_pixels] = [0, 0, 255]
 
     if verbose:
+        ploty, left_fitx, right_fitx = get_fit_curves(line_lt, line_rt, height, diagnostics.scale)
+
         f, ax = plt.subplots(1, 2)
         f.set_facecolor('white')
         ax[0].imshow(birdeye_binary, cmap='gray')
         ax[1].imshow(out_img)
-        ax[1].plot(left_fitx, ploty, color='yellow')
-        ax[1].plot(right_fitx, ploty, color='yellow')
+        for fitx in (left_fitx, right_fitx):
+            if fitx is not None:
+                ax[1].plot(fitx, ploty, color='yellow')
         ax[1].set_xlim(0, 1280)
         ax[1].set_ylim(720, 0)
 
         plt.show()
 
-    return line_lt, line_rt, out_img
+    return out_img
 
 
-def get_fits_by_previous_fits(birdeye_binary, line_lt, line_rt, verbose=False):
+def get_fits_by_sliding_windows(birdeye_binary, line_lt, line_rt, n_windows=9, verbose=False, scale=1.0):
     """
-    Get polynomial coefficients for lane-lines detected in an binary image.
-    This function starts from previously detected lane-lines to speed-up the search of lane-lines in the current frame.
+    Get polynomial coefficients for lane-lines detected in an binary image, and render the search.
 
     :param birdeye_binary: input bird's eye view binary image
     :param line_lt: left lane-line previously detected
     :param line_rt: left lane-line previously detected
+    :param n_windows: number of sliding windows used to search for the lines
     :param verbose: if True, display intermediate output
-    :return: updated lane lines and output image
+    :param scale: scale of birdeye_binary relative to full resolution; pixels and fits are
+                  mapped back so lines are always expressed in full resolution pixels
+    :return: updated lane lines and output image (at the scale of birdeye_binary)
     """
+    line_lt, line_rt, diagnostics = fit_by_sliding_windows(birdeye_binary, line_lt, line_rt, n_windows, scale)
+    out_img = render_sliding_windows(birdeye_binary, line_lt, line_rt, diagnostics, verbose)
 
+    return line_lt, line_rt, out_img
+
+
+def get_band_pixels(birdeye_binary, fit, margin):
+    """
+    Nonzero pixels strictly within +/- margin of a polynomial x = f(y).
+
+    The polynomial is evaluated once per row and only the [x - margin, x + margin] slice of
+    every row is read, instead of testing every nonzero pixel of the image.
+
+    :param birdeye_binary: bird's eye view binary image
+    :param fit: polynomial coefficients (pixel, at the scale of birdeye_binary)
+    :param margin: half width of the band
+    :return: y and x coordinates of the pixels, in row-major order like nonzero()
+    """
     height, width = birdeye_binary.shape
 
-    left_fit_pixel = line_lt.last_fit_pixel
-    right_fit_pixel = line_rt.last_fit_pixel
+    rows = np.arange(height)
+    center = fit[0] * (rows ** 2) + fit[1] * rows + fit[2]
+
+    # first and last column strictly inside the band, clipped to the image
+    x_first = np.floor(np.clip(center - margin, -1, width)).astype(np.int64) + 1
+    x_last = np.ceil(np.clip(center + margin, -1, width)).astype(np.int64) - 1
+    x_first = np.maximum(x_first, 0)
+    x_last = np.minimum(x_last, width - 1)
 
+    # gather the band of every row as one (height, 2 * margin) block
+    offsets = np.arange(2 * margin)
+    cols = x_first[:, None] + offsets
+    inside = cols <= x_last[:, None]
+
+    flat_index = rows[:, None] * width + np.minimum(cols, width - 1)
+    band = birdeye_binary.ravel().take(flat_index)
+
+    band_y, band_k = np.nonzero(band.astype(bool, copy=False) & inside)
+
+    return band_y, x_first[band_y] + band_k
+
+
+def get_band_pixels_reference(birdeye_binary, fit, margin):
+    """
+    Same as get_band_pixels, testing every nonzero pixel of the image.
+    """
     nonzero = birdeye_binary.nonzero()
     nonzero_y = np.array(nonzero[0])
     nonzero_x = np.array(nonzero[1])
-    margin = 100
-    left_lane_inds = (
-    (nonzero_x > (left_fit_pixel[0] * (nonzero_y ** 2) + left_fit_pixel[1] * nonzero_y + left_fit_pixel[2] - margin)) & (
-    nonzero_x < (left_fit_pixel[0] * (nonzero_y ** 2) + left_fit_pixel[1] * nonzero_y + left_fit_pixel[2] + margin)))
-    right_lane_inds = (
-    (nonzero_x > (right_fit_pixel[0] * (nonzero_y ** 2) + right_fit_pixel[1] * nonzero_y + right_fit_pixel[2] - margin)) & (
-    nonzero_x < (right_fit_pixel[0] * (nonzero_y ** 2) + right_fit_pixel[1] * nonzero_y + right_fit_pixel[2] + margin)))
-
-    # Extract left and right line pixel positions
-    line_lt.all_x, line_lt.all_y = nonzero_x[left_lane_inds], nonzero_y[left_lane_inds]
-    line_rt.all_x, line_rt.all_y = nonzero_x[right_lane_inds], nonzero_y[right_lane_inds]
 
-    detected = True
-    if not list(line_lt.all_x) or not list(line_lt.all_y):
-        left_fit_pixel = line_lt.last_fit_pixel
-        left_fit_meter = line_lt.last_fit_meter
-        detected = False
-    else:
-        left_fit_pixel = np.polyfit(line_lt.all_y, line_lt.all_x, 2)
-        left_fit_meter = np.polyfit(line_lt.all_y * ym_per_pix, line_lt.all_x * xm_per_pix, 2)
+    center = fit[0] * (nonzero_y ** 2) + fit[1] * nonzero_y + fit[2]
+    inds = (nonzero_x > center - margin) & (nonzero_x < center + margin)
 
-    if not list(line_rt.all_x) or not list(line_rt.all_y):
-        right_fit_pixel = line_rt.last_fit_pixel
-        right_fit_meter = line_rt.last_fit_meter
-        detected = False
-    else:
-        right_fit_pixel = np.polyfit(line_rt.all_y, line_rt.all_x, 2)
-        right_fit_meter = np.polyfit(line_rt.all_y * ym_per_pix, line_rt.all_x * xm_per_pix, 2)
+    return nonzero_y[inds], nonzero_x[inds]
 
-    line_lt.update_line(left_fit_pixel, left_fit_meter, detected=detected)
-    line_rt.update_line(right_fit_pixel, right_fit_meter, detected=detected)
 
-    # Generate x and y values for plotting
-    ploty = np.linspace(0, height - 1, height)
-    left_fitx = left_fit_pixel[0] * ploty ** 2 + left_fit_pixel[1] * ploty + left_fit_pixel[2]
-    right_fitx = right_fit_pixel[0] * ploty ** 2 + right_fit_pixel[1] * ploty + right_fit_pixel[2]
+def fit_by_previous_fits(birdeye_binary, line_lt, line_rt, scale=1.0):
+    """
+    Get polynomial coefficients for lane-lines detected in an binary image, without rendering anything.
+    This function starts from previously detected lane-lines to speed-up the search of lane-lines in the current frame.
+
+    :param birdeye_binary: input bird's eye view binary image
+    :param line_lt: left lane-line previously detected
+    :param line_rt: left lane-line previously detected
+    :param scale: scale of birdeye_binary relative to full resolution; pixels and fits are
+                  mapped back so lines are always expressed in full resolution pixels
+    :return: updated lane lines and LaneFitDiagnostics
+    """
+    height, width = birdeye_binary.shape
+
+    margin = int(100 * scale)
+    left_pixels = get_band_pixels(birdeye_binary, scale_fit(line_lt.last_fit_pixel, scale), margin)
+    right_pixels = get_band_pixels(birdeye_binary, scale_fit(line_rt.last_fit_pixel, scale), margin)
+
+    detected = update_fits(line_lt, line_rt, left_pixels, right_pixels, height, scale)
+
+    return line_lt, line_rt, LaneFitDiagnostics(detected, left_pixels, right_pixels, None, margin, scale)
+
 
-    # Create an image to draw on and an image to show the selection window
+def render_previous_fits(birdeye_binary, line_lt, line_rt, diagnostics, verbose=False):
+    """
+    Draw the outcome of fit_by_previous_fits.
+
+    :param birdeye_binary: the searched bird's eye view binary image
+    :param line_lt: left lane-line, as updated by the search
+    :param line_rt: right lane-line, as updated by the search
+    :param diagnostics: LaneFitDiagnostics returned by the search
+    :param verbose: if True, display the output with the search window area
+    :return: output image (at the scale of birdeye_binary)
+    """
+    height, width = birdeye_binary.shape
+    margin = diagnostics.margin
+
+    # Create an image to draw on
     img_fit = np.dstack((birdeye_binary, birdeye_binary, birdeye_binary)) * 255
-    window_img = np.zeros_like(img_fit)
 
     # Color in left and right line pixels
-    img_fit[nonzero_y[left_lane_inds], nonzero_x[left_lane_inds]] = [255, 0, 0]
-    img_fit[nonzero_y[right_lane_inds], nonzero_x[right_lane_inds]] = [0, 0, 255]
-
-    # Generate a polygon to illustrate the search window area
-    # And recast the x and y points into usable format for cv2.fillPoly()
-    left_line_window1 = np.array([np.transpose(np.vstack([left_fitx - margin, ploty]))])
-    left_line_window2 = np.array([np.flipud(np.transpose(np.vstack([left_fitx + margin, ploty])))])
-    left_line_pts = np.hstack((left_line_window1, left_line_window2))
-    right_line_window1 = np.array([np.transpose(np.vstack([right_fitx - margin, ploty]))])
-    right_line_window2 = np.array([np.flipud(np.transpose(np.vstack([right_fitx + margin, ploty])))])
-    right_line_pts = np.hstack((right_line_window1, right_line_window2))
-
-    # Draw the lane onto the warped blank image
-    cv2.fillPoly(window_img, np.int_([left_line_pts]), (0, 255, 0))
-    cv2.fillPoly(window_img, np.int_([right_line_pts]), (0, 255, 0))
-    result = cv2.addWeighted(img_fit, 1, window_img, 0.3, 0)
+    img_fit[diagnostics.left_pixels] = [255, 0, 0]
+    img_fit[diagnostics.right_pixels] = [0, 0, 255]
 
     if verbose:
+        ploty, left_fitx, right_fitx = get_fit_curves(line_lt, line_rt, height, diagnostics.scale)
+
+        # Generate a polygon to illustrate the search window area
+        # And recast the x and y points into usable format for cv2.fillPoly()
+        window_img = np.zeros_like(img_fit)
+        fitxs = [fitx for fitx in (left_fitx, right_fitx) if fitx is not None]
+        for fitx in fitxs:
+            line_window1 = np.array([np.transpose(np.vstack([fitx - margin, ploty]))])
+            line_window2 = np.array([np.flipud(np.transpose(np.vstack([fitx + margin, ploty])))])
+            line_pts = np.hstack((line_window1, line_window2))
+            cv2.fillPoly(window_img, np.int_([line_pts]), (0, 255, 0))
+
+        result = cv2.addWeighted(img_fit, 1, window_img, 0.3, 0)
+
         plt.imshow(result)
-        plt.plot(left_fitx, ploty, color='yellow')
-        plt.plot(right_fitx, ploty, color='yellow')
+        for fitx in fitxs:
+            plt.plot(fitx, ploty, color='yellow')
         plt.xlim(0, 1280)
         plt.ylim(720, 0)
 
         plt.show()
 
+    return img_fit
+
+
+def get_fits_by_previous_fits(birdeye_binary, line_lt, line_rt, verbose=False, scale=1.0):
+    """
+    Get polynomial coefficients for lane-lines detected in an binary image, and render the search.
+    This function starts from previously detected lane-lines to speed-up the search of lane-lines in the current frame.
+
+    :param birdeye_binary: input bird's eye view binary image
+    :param line_lt: left lane-line previously detected
+    :param line_rt: left lane-line previously detected
+    :param verbose: if True, display intermediate output
+    :param scale: scale of birdeye_binary relative to full resolution; pixels and fits are
+                  mapped back so lines are always expressed in full resolution pixels
+    :return: updated lane lines and output image (at the scale of birdeye_binary)
+    """
+    line_lt, line_rt, diagnostics = fit_by_previous_fits(birdeye_binary, line_lt, line_rt, scale)
+    img_fit = render_previous_fits(birdeye_binary, line_lt, line_rt, diagnostics, verbose)
+
     return line_lt, line_rt, img_fit
 
 
+def compute_offset_from_center(line_lt, line_rt, frame_width):
+    """
+    Compute offset from center of the inferred lane.
+    The offset from the lane center can be computed under the hypothesis that the camera is fixed
+    and mounted in the midpoint of the car roof. In this case, we can approximate the car's deviation
+    from the lane center as the distance between the center of the image and the midpoint at the bottom
+    of the image of the two lane-lines detected.
+    :param line_lt: detected left lane-line
+    :param line_rt: detected right lane-line
+    :param frame_width: width of the undistorted frame
+    :return: inferred offset
+    """
+    if line_lt.detected and line_rt.detected:
+        line_lt_bottom = np.mean(line_lt.all_x[line_lt.all_y > 0.95 * line_lt.all_y.max()])
+        line_rt_bottom = np.mean(line_rt.all_x[line_rt.all_y > 0.95 * line_rt.all_y.max()])
+        lane_width = line_rt_bottom - line_lt_bottom
+        midpoint = frame_width / 2
+        offset_pix = abs((line_lt_bottom + lane_width / 2) - midpoint)
+        offset_meter = xm_per_pix * offset_pix
+    else:
+        offset_meter = -1
+
+    return offset_meter
+
+
 def draw_back_onto_the_road(img_undistorted, Minv, line_lt, line_rt, keep_state):
     """
     Draw both the drivable lane area and the detected lane-lines onto the original (undistorted) frame.
@@ -0,0 +1,184 @@
+'''
+Compiled morphology chains
+
+A chain of morphology operations is held as data and compiled into the
+shortest equivalent sequence of erosions and dilations, which then runs on
+preallocated ping-pong buffers.
+'''
+
+import cv2
+import numpy as np
+
+# primitive operations a chain compiles down to
+PRIMITIVES = {
+    'erode': cv2.erode,
+    'dilate': cv2.dilate,
+}
+
+# composite operations, expanded into primitives
+COMPOSITES = {
+    'open': ('erode', 'dilate'),
+    'close': ('dilate', 'erode'),
+}
+
+
+def is_odd_rectangle(kernel):
+    """
+    True if the kernel is a full rectangle of odd size (centered anchor).
+    """
+    return kernel.all() and kernel.shape[0] % 2 == 1 and kernel.shape[1] % 2 == 1
+
+
+class MorphologyPlan:
+    """
+    A morphology chain compiled into a short list of erode / dilate steps.
+
+    Compilation expands open / close into erode and dilate, then merges adjacent steps of
+    the same type. Consecutive erosions (or dilations) with odd rectangular kernels fold into
+    a single larger rectangle, which is exact since rectangles are closed under Minkowski sums,
+    and repeated steps with the same kernel fold into one call with more iterations.
+    """
+    def __init__(self, operations):
+        """
+        :param operations: list of (operation, kernel, iterations), operation being one of
+                           'erode', 'dilate', 'open' or 'close'
+        """
+        self.operations = [(operation, np.asarray(kernel, dtype=np.uint8), iterations)
+                           for operation, kernel, iterations in operations]
+        self.steps = self.compile(self.operations)
+
+        # ping-pong buffers, reused as long as the input shape and type do not change
+        self._buffers = None
+
+    @staticmethod
+    def compile(operations):
+        """
+        Compile a chain into a list of (primitive, kernel, iterations) steps.
+        """
+        steps = []
+
+        for operation, kernel, iterations in operations:
+            primitives = COMPOSITES.get(operation, (operation,))
+
+            for primitive in primitives:
+                if primitive not in PRIMITIVES:
+                    raise ValueError('Unknown morphology operation: %s' % operation)
+
+                step_kernel, step_iterations = kernel, iterations
+
+                # a single pixel kernel leaves the image unchanged
+                if step_kernel.shape == (1, 1) and step_kernel.all():
+                    continue
+
+                # n iterations of a rectangle are one pass of a larger rectangle
+                if is_odd_rectangle(step_kernel) and step_iterations > 1:
+                    h, w = step_kernel.shape
+                    step_kernel = np.ones((h + (h - 1) * (step_iterations - 1), w + (w - 1) * (step_iterations - 1)), np.uint8)
+                    step_iterations = 1
+
+                if steps and steps[-1][0] == primitive:
+                    _, last_kernel, last_iterations = steps[-1]
+
+                    if is_odd_rectangle(last_kernel) and is_odd_rectangle(step_kernel):
+                        h = last_kernel.shape[0] + step_kernel.shape[0] - 1
+                        w = last_kernel.shape[1] + step_kernel.shape[1] - 1
+                        steps[-1] = (primitive, np.ones((h, w), np.uint8), 1)
+                        continue
+
+                    if np.array_equal(last_kernel, step_kernel):
+                        steps[-1] = (primitive, last_kernel, last_iterations + step_iterations)
+                        continue
+
+                steps.append((primitive, step_kernel, step_iterations))
+
+        return steps
+
+    def scaled(self, scale):
+        """
+        Plan for an image downscaled by the given factor.
+
+        Rectangular kernels (including their iterations) are resized to the nearest odd size
+        covering the same area of the scene, other kernels are kept as they are.
+
+        :param scale: image scale relative to the one the chain was written for
+        :return: new MorphologyPlan
+        """
+        operations = []
+
+        for operation, kernel, iterations in self.operations:
+            if is_odd_rectangle(kernel):
+                sizes = [size + (size - 1) * (iterations - 1) for size in kernel.shape]
+                h, w = [max(1, 2 * int(round((size * scale - 1) / 2)) + 1) for size in sizes]
+                operations.append((operation, np.ones((h, w), np.uint8), 1))
+            else:
+                operations.append((operation, kernel, iterations))
+
+        return MorphologyPlan(operations)
+
+    def get_buffers(self, shape, dtype):
+        if self._buffers is None or self._buffers[0].shape != shape or self._buffers[0].dtype != dtype:
+            self._buffers = (np.empty(shape, dtype=dtype), np.empty(shape, dtype=dtype))
+        return self._buffers
+
+    def apply(self, src, dst=None):
+        """
+        Run the compiled chain.
+
+        :param src: input image
+        :param dst: optional output image, may be src itself
+        :return: output image
+        """
+        if dst is None:
+            dst = np.empty_like(src)
+
+        if not self.steps:
+            np.copyto(dst, src)
+            return dst
+
+        buffers = self.get_buffers(src.shape, src.dtype)
+
+        current = src
+        for i, (primitive, kernel, iterations) in enumerate(self.steps):
+            target = dst if i == len(self.steps) - 1 else buffers[i % 2]
+            PRIMITIVES[primitive](current, kernel, dst=target, iterations=iterations)
+            current = target
+
+        return dst
+
+    def apply_reference(self, src):
+        """
+        Run the chain exactly as written, one OpenCV call per operation.
+
+        :param src: input image
+        :return: output image
+        """
+        out = src
+        for operation, kernel, iterations in self.operations:
+            if operation in COMPOSITES:
+                op = cv2.MORPH_OPEN if operation == 'open' else cv2.MORPH_CLOSE
+                out = cv2.morphologyEx(out, op, kernel, iterations=iterations)
+            else:
+                out = PRIMITIVES[operation](out, kernel, iterations=iterations)
+        return out
+
+    def verify(self, images):
+        """
+        Check the compiled chain against the reference chain.
+
+        :param images: iterable of input images
+        :return: number of images checked and number of pixels that differ in total
+        """
+        num_images = 0
+        num_different = 0
+
+        for image in images:
+            num_images += 1
+            num_different += int(np.count_nonzero(self.apply(image) != self.apply_reference(image)))
+
+        return num_images, num_different
+
+    def __repr__(self):
+        steps = ', '.join('%s %ix%i%s' % (primitive, kernel.shape[1], kernel.shape[0],
+                                          ' x%i' % iterations if iterations > 1 else '')
+                          for primitive, kernel, iterations in self.steps)
+        return 'MorphologyPlan(%s)' % steps
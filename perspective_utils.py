@@ -4,17 +4,18 @@ import glob
 import matplotlib.pyplot as plt
 from calibration_utils import calibrate_camera, undistort
 from binarization_utils import binarize
+from functools import lru_cache
+from homography_utils import get_perspective_transforms
 
 
-def birdeye(img, verbose=False):
+@lru_cache(maxsize=None)
+def get_birdeye_points(h, w):
     """
-    Apply perspective transform to input frame to get the bird's eye view.
-    :param img: input color frame
-    :param verbose: if True, show the transformation result
-    :return: warped image, and both forward and backward transformation matrices
+    Source and destination points of the bird's eye transform for a given frame size.
+    :param h: frame height
+    :param w: frame width
+    :return: read-only src and dst points
     """
-    h, w = img.shape[:2]
-
     src = np.float32([[w, h-10],    # br
                       [0, h-10],    # bl
                       [546, 460],   # tl
@@ -24,8 +25,23 @@ def birdeye(img, verbose=False):
                       [0, 0],       # tl
                       [w, 0]])      # tr
 
-    M = cv2.getPerspectiveTransform(src, dst)
-    Minv = cv2.getPerspectiveTransform(dst, src)
+    src.setflags(write=False)
+    dst.setflags(write=False)
+
+    return src, dst
+
+
+def birdeye(img, verbose=False):
+    """
+    Apply perspective transform to input frame to get the bird's eye view.
+    :param img: input color frame
+    :param verbose: if True, show the transformation result
+    :return: warped image, and both forward and backward transformation matrices
+    """
+    h, w = img.shape[:2]
+
+    src, dst = get_birdeye_points(h, w)
+    M, Minv = get_perspective_transforms(img.shape, src, dst)
 
     warped = cv2.warpPerspective(img, M, (w, h), flags=cv2.INTER_LINEAR)
 
@@ -47,6 +63,109 @@ def birdeye(img, verbose=False):
     return warped, M, Minv
 
 
+def region_of_interest( img ):
+    '''region_of_interest
+
+    Extract the region of interest of the image
+
+    Arguments:
+        img:(np.darray) image
+
+    Return:
+        collective points of the image region of interest
+    '''
+
+    return get_roi_points(img.shape[:2])
+
+
+@lru_cache(maxsize=None)
+def get_roi_points( imshape ):
+    '''get_roi_points
+
+    Build the region of interest vertices for a frame shape once and reuse them
+
+    Arguments:
+        imshape:(tuple) frame ( height , width )
+
+    Return:
+        read-only source and destination points
+    '''
+    # Format as ( 0 y , 1 x , channels )
+    #=======================================
+    # For GTA5
+    #=======================================
+    # vertices = np.array([
+    #     [(.63*imshape[1], 0.30*imshape[0]),
+    #      (imshape[1]    ,imshape[0]),
+    #      (0,imshape[0]),
+    #      (.45*imshape[1], 0.30*imshape[0])]],
+    #     dtype=np.float32)
+
+    '''
+    vertices = np.array([
+        [(.57*imshape[1], 0.42*imshape[0]),
+         (imshape[1]    ,.81*imshape[0]),
+         (0,.7*imshape[0]),
+         (.40*imshape[1], 0.42*imshape[0])]],
+        dtype=np.float32)
+    '''
+
+    height_factor = 0.3
+    width_factor = 0.2
+    lower_width_factor = 0.4
+
+    vertices = np.array([
+        [((0.5+width_factor)*imshape[1],    height_factor*imshape[0]), # top right
+         (imshape[1]+imshape[1]*lower_width_factor,                       imshape[0]), # bottom right
+         (0-imshape[1]*lower_width_factor,                                imshape[0]), # bottom left
+         ((0.5-width_factor)*imshape[1],    height_factor*imshape[0])]], # top left
+        dtype=np.float32)
+
+
+
+    src = np.float32(vertices)
+
+    '''
+    dst = np.float32([
+                      [0.75*imshape[1],0],
+                      [0.75*imshape[1],imshape[0]+150],
+                      [0.25*imshape[1],imshape[0]+150],
+                      [0.25*imshape[1],0]])
+    '''
+    dst = np.float32([
+                      [imshape[1],    0],
+                      [imshape[1],    imshape[0]],
+                      [0,               imshape[0]],
+                      [0,               0]])
+
+    src.setflags(write=False)
+    dst.setflags(write=False)
+
+    return src , dst
+
+def get_birds_eye_view( img , src_pts , dst_pts ):
+    '''get_birds_eye_view
+
+    Fit Transform geomtric region of the data to
+    a Wrapped perspective for a bird view prediction
+
+    Arguments:
+        img:(np.darray) image to be transform to
+        src_pts:(np.darray) source points for image region
+        dst_pts: (np.darray) destination points of image region
+
+    Returns:
+        Warpped Perspective
+
+    '''
+
+    img_size = (img.shape[ 1 ] , img.shape[0])
+
+    M, Minv = get_perspective_transforms(img.shape, src_pts, dst_pts)
+
+    return cv2.warpPerspective(img, M , img_size ), M, Minv
+
+
 if __name__ == '__main__':
 
     ret, mtx, dist, rvecs, tvecs = calibrate_camera(calib_images_dir='camera_cal')
@@ -5,15 +5,21 @@ from calibration import CameraCalibration
 import binarization_utils
 import matplotlib.pyplot as plt
 import line_utils
-from line_utils import Line
-from globals import xm_per_pix, time_window
+from line_utils import Line, compute_offset_from_center
+from lane_tracker import LaneTracker
+from globals import time_window, processing_scale
 import communication.serial_communication as comm
 #from trafficlightdetector import TrafficLightDetector
 import logging
 from glob import glob
+from perspective_utils import region_of_interest, get_birds_eye_view
+import visualization
 
 global line_lt, line_rt, processed_frames
 
+# set to True on the vehicle, debug images are then never rendered
+HEADLESS = False
+
 line_lt = Line(buffer_len=time_window)  # line on the left of the lane
 line_rt = Line(buffer_len=time_window) # line on the right of the lane
 processed_frames = 0
@@ -46,96 +52,6 @@ def debug_roi( img , src_pts , dst_pts , debug=False ):
 
 
 
-def region_of_interest( img ):
-    '''region_of_interest
-
-    Extract the region of interest of the image
-
-    Arguments:
-        img:(np.darray) image
-
-    Return:
-        collective points of the image region of interest
-    '''
-
-    imshape= img.shape
-    # Format as ( 0 y , 1 x , channels )
-    #=======================================
-    # For GTA5
-    #=======================================
-    # vertices = np.array([
-    #     [(.63*imshape[1], 0.30*imshape[0]),
-    #      (imshape[1]    ,imshape[0]),
-    #      (0,imshape[0]),
-    #      (.45*imshape[1], 0.30*imshape[0])]],
-    #     dtype=np.float32)
-
-    '''
-    vertices = np.array([
-        [(.57*imshape[1], 0.42*imshape[0]),
-         (imshape[1]    ,.81*imshape[0]),
-         (0,.7*imshape[0]),
-         (.40*imshape[1], 0.42*imshape[0])]],
-        dtype=np.float32)
-    '''
-
-    height_factor = 0.3
-    width_factor = 0.2
-    lower_width_factor = 0.4
-
-    vertices = np.array([
-        [((0.5+width_factor)*imshape[1],    height_factor*imshape[0]), # top right
-         (imshape[1]+imshape[1]*lower_width_factor,                       imshape[0]), # bottom right
-         (0-imshape[1]*lower_width_factor,                                imshape[0]), # bottom left
-         ((0.5-width_factor)*imshape[1],    height_factor*imshape[0])]], # top left
-        dtype=np.float32)
-
-
-
-    src = np.float32(vertices)
-
-    '''
-    dst = np.float32([
-                      [0.75*img.shape[1],0],
-                      [0.75*img.shape[1],img.shape[0]+150],
-                      [0.25*img.shape[1],img.shape[0]+150],
-                      [0.25*img.shape[1],0]])
-    '''
-    dst = np.float32([
-                      [img.shape[1],    0],
-                      [img.shape[1],    img.shape[0]],
-                      [0,               img.shape[0]],
-                      [0,               0]])
-
-
-
-
-    return src , dst
-
-def get_birds_eye_view( img , src_pts , dst_pts ):
-    '''get_birds_eye_view
-
-    Fit Transform geomtric region of the data to
-    a Wrapped perspective for a bird view prediction
-
-    Arguments:
-        img:(np.darray) image to be transform to
-        src_pts:(np.darray) source points for image region
-        dst_pts: (np.darray) destination points of image region
-
-    Returns:
-        Warpped Perspective
-
-    '''
-
-    img_size = (img.shape[ 1 ] , img.shape[0])
-
-    M    = cv2.getPerspectiveTransform(np.float32(src_pts), np.float32(dst_pts))
-    Minv = cv2.getPerspectiveTransform(np.float32(dst_pts), np.float32(src_pts))
-
-    return cv2.warpPerspective(img, M , img_size ), M, Minv
-
-
 def filter_hsv_colour(img, upper_thresh, lower_thresh):
     hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
 
@@ -145,31 +61,6 @@ def filter_hsv_colour(img, upper_thresh, lower_thresh):
     return mask, res
 
 
-def compute_offset_from_center(line_lt, line_rt, frame_width):
-    """
-    Compute offset from center of the inferred lane.
-    The offset from the lane center can be computed under the hypothesis that the camera is fixed
-    and mounted in the midpoint of the car roof. In this case, we can approximate the car's deviation
-    from the lane center as the distance between the center of the image and the midpoint at the bottom
-    of the image of the two lane-lines detected.
-    :param line_lt: detected left lane-line
-    :param line_rt: detected right lane-line
-    :param frame_width: width of the undistorted frame
-    :return: inferred offset
-    """
-    if line_lt.detected and line_rt.detected:
-        line_lt_bottom = np.mean(line_lt.all_x[line_lt.all_y > 0.95 * line_lt.all_y.max()])
-        line_rt_bottom = np.mean(line_rt.all_x[line_rt.all_y > 0.95 * line_rt.all_y.max()])
-        lane_width = line_rt_bottom - line_lt_bottom
-        midpoint = frame_width / 2
-        offset_pix = abs((line_lt_bottom + lane_width / 2) - midpoint)
-        offset_meter = xm_per_pix * offset_pix
-    else:
-        offset_meter = -1
-
-    return offset_meter
-
-
 def prepare_out_blend_frame(blend_on_road, img_binary, img_birdeye, img_fit, line_lt, line_rt, offset_meter):
     """
     Prepare the final pretty pretty output blend, given all intermediate pipeline images
@@ -219,9 +110,12 @@ def prepare_out_blend_frame(blend_on_road, img_binary, img_birdeye, img_fit, lin
 
 
 
-def main():
+def main(headless=HEADLESS):
     logging.basicConfig(level=logging.DEBUG)
 
+    # debug images are shown from a background thread, or dropped entirely when headless
+    visualization.set_sink(visualization.HeadlessSink() if headless else visualization.DisplaySink())
+
     cap = cv2.VideoCapture('footage/7_edit.avi')
 
     '''
@@ -232,17 +126,15 @@ def main():
     cap.set(cv2.CAP_PROP_FRAME_HEIGHT,720)
     '''
 
-    DIM = (640, 480)
-    K = np.array([[359.0717640266508, 0.0, 315.08914578097387], [0.0, 358.06497428501837, 240.75242680088732], [0.0, 0.0, 1.0]])
-    D = np.array([[-0.041705903204711826], [0.3677107787593379], [-1.4047363783373128], [1.578157237454529]])
-    profile = (DIM, K, D)
-    CC = CameraCalibration(profile)
+    # binary profile written by CameraCalibration.export_data, see calibration.py
+    CC = CameraCalibration.from_camera_id(0)
 
     yellow_HSV_th_min = np.array([0, 70, 70])
     yellow_HSV_th_max = np.array([50, 255, 255])
 
     line_lt = Line(buffer_len=time_window)  # line on the left of the lane
     line_rt = Line(buffer_len=time_window) # line on the right of the lane
+    lane_tracker = LaneTracker(buffer_len=time_window)
     processed_frames = 0
 
     ### traffic light detector setup ###
@@ -271,23 +163,20 @@ def main():
             logging.debug('traffic light state:', str(state))
 
             if state == 'green':
-                comm.write_serial_message('s30')
+                comm.set_speed(30)
                 break
         '''
 
 
 
 
-        frame = CC.undistort(frame)
-
         ### calibration ###
-
-
         ### crop to ROI ###
         ### perspective transform ###
 
-
-        img, warped = debug_roi(frame, None, None)
+        # undistortion and bird's eye warp are fused into a single remap of the raw frame
+        src_pts, dst_pts = region_of_interest(frame)
+        warped = CC.undistort_birds_eye(frame, src_pts, dst_pts)
 
 
         ### binarize frame ###
@@ -311,8 +200,10 @@ def main():
 
         #mask, res = filter_hsv_colour(img, yellow_HSV_th_max, yellow_HSV_th_min)
 
-        img_binary = binarization_utils.binarize(warped, verbose=False)
-        cv2.imshow('img binary', img_binary)
+        # lane mask at the processing scale for the lane search, mapped back to full resolution for the rest
+        lane_binary = binarization_utils.binarize(warped, verbose=False, scale=processing_scale, full_resolution=False)
+        img_binary = binarization_utils.upscale(lane_binary, warped.shape)
+        visualization.publish('img binary', img_binary)
 
 
         ### contours ###
@@ -343,31 +234,32 @@ def main():
 
         turn_angle += 90
 
-        turn_angle_message = str('a%d' % int(turn_angle))
-        comm.write_serial_message(turn_angle_message)
-        #comm.write_serial_message('s50')
+        comm.set_angle(int(turn_angle))
+        #comm.set_speed(50)
 
         cv2.putText(lines, str(int(turn_angle)), (200, 450), cv2.FONT_HERSHEY_SIMPLEX, 4, (0,255,0), 4, cv2.LINE_AA)
-        cv2.imshow('lines', lines)
+        visualization.publish('lines', lines)
 
 
-        '''
-        keep_state = False
-
+        ### lane tracking ###
+        # corridor search around the predicted lines, sliding windows when the track is lost
+        line_lt, line_rt, fit_diagnostics = lane_tracker.update(lane_binary, scale=processing_scale)
+        logging.debug('lane search: %s, confidence: %.2f', lane_tracker.search, lane_tracker.confidence)
 
-        if processed_frames > 0 and keep_state and line_lt.detected and line_rt.detected:
-            line_lt, line_rt, img_fit = line_utils.get_fits_by_previous_fits(img_binary, line_lt, line_rt, verbose=False)
-        else:
-            line_lt, line_rt, img_fit = line_utils.get_fits_by_sliding_windows(img_binary, line_lt, line_rt, n_windows=9, verbose=False)
+        # the fit image is only rendered when someone looks at it
+        if not headless:
+            render_fit = line_utils.render_sliding_windows if fit_diagnostics.windows else line_utils.render_previous_fits
+            img_fit = render_fit(lane_binary, line_lt, line_rt, fit_diagnostics)
+            visualization.publish('img fit', img_fit)
 
         offset_meter = compute_offset_from_center(line_lt, line_rt, frame_width=frame.shape[1])
-        '''
+        logging.debug('offset from lane center: %.2f m', offset_meter)
         #print(offset_meter)
 
         #Minv = np.zeros(shape=(3, 3))
 
         # draw the surface enclosed by lane lines back onto the original frame
-        #blend_on_road = line_utils.draw_back_onto_the_road(img, Minv, line_lt, line_rt, keep_state)
+        #blend_on_road = line_utils.draw_back_onto_the_road(img, Minv, line_lt, line_rt, keep_state=True)
 
         #cv2.imshow('asfdfd', blend_on_road)
 
@@ -381,16 +273,18 @@ def main():
 
 
 
-        cv2.imshow('frame', frame)
-        cv2.imshow('warped', warped)
+        # the pipeline never builds the undistorted frame, it is only undistorted for display
+        if not headless:
+            visualization.publish('frame', CC.undistort(frame))
+        visualization.publish('warped', warped)
 
 
-        if cv2.waitKey(1) & 0xFF == ord('q'):
+        if visualization.quit_requested():
                 break
 
 
     cap.release()
-    cv2.destroyAllWindows()
+    visualization.close()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,114 @@
+'''
+Second order polynomial fits x = a*y^2 + b*y + c from accumulated moments
+
+Instead of running a least-squares solver on the raw pixel coordinates, the
+power sums of y (up to y^4) and of x*y^k (up to k = 2) are accumulated and
+the 3x3 normal equations are solved directly. y is normalized by a fixed
+scale (the frame height) so the system stays well conditioned.
+'''
+
+import numpy as np
+
+from globals import ym_per_pix, xm_per_pix
+
+# above this condition number the normal equations are solved in the least-squares sense
+MAX_CONDITION = 1e10
+
+
+class PolyFitAccumulator:
+    """
+    Running moments of a set of (x, y) points, optionally weighted.
+
+    Points can be added in several batches (e.g. one per search window) and the fit is
+    only solved when asked for.
+    """
+    def __init__(self, y_scale=1.0):
+        """
+        :param y_scale: y values are divided by this before accumulating, use the frame height
+        """
+        self.y_scale = float(y_scale)
+        self.reset()
+
+    def reset(self):
+        # sums of w * y^k for k = 0..4
+        self.sy = np.zeros(5)
+        # sums of w * x * y^k for k = 0..2
+        self.sxy = np.zeros(3)
+        # number of points (unweighted)
+        self.count = 0
+
+    def add(self, x, y, weights=None):
+        """
+        Accumulate a batch of points.
+
+        :param x: x coordinates
+        :param y: y coordinates
+        :param weights: optional weight of every point
+        """
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64) * (1. / self.y_scale)
+
+        if not len(x):
+            return
+
+        y2 = y * y
+        if weights is None:
+            w, wx = y.size, x.sum()
+            wy, wy2 = y, y2
+        else:
+            weights = np.asarray(weights, dtype=np.float64)
+            w, wx = weights.sum(), weights.dot(x)
+            wy, wy2 = weights * y, weights * y2
+
+        self.sy += (w, wy.sum(), wy2.sum(), wy2.dot(y), wy2.dot(y2))
+        self.sxy += (wx, wy.dot(x), wy2.dot(x))
+        self.count += len(x)
+
+    def solve(self):
+        """
+        Solve the normal equations.
+
+        Falls back to a least-squares solution when the system is singular (e.g. fewer than
+        three distinct rows) or too badly conditioned, like np.polyfit does.
+
+        :return: polynomial coefficients [a, b, c] in pixel units, highest power first
+        """
+        s = self.sy
+        A = np.array([[s[4], s[3], s[2]],
+                      [s[3], s[2], s[1]],
+                      [s[2], s[1], s[0]]])
+        b = self.sxy[::-1]
+
+        if self.count >= 3 and np.linalg.cond(A) < MAX_CONDITION:
+            fit = np.linalg.solve(A, b)
+        else:
+            fit = np.linalg.lstsq(A, b, rcond=None)[0]
+
+        # undo the normalization of y
+        return fit * (1. / self.y_scale ** 2, 1. / self.y_scale, 1.)
+
+
+def fit_poly2(x, y, y_scale=1.0, weights=None):
+    """
+    Fit x = a*y^2 + b*y + c to a set of points.
+
+    :param x: x coordinates
+    :param y: y coordinates
+    :param y_scale: normalization of y, use the frame height
+    :param weights: optional weight of every point
+    :return: polynomial coefficients [a, b, c], highest power first as with np.polyfit
+    """
+    accumulator = PolyFitAccumulator(y_scale)
+    accumulator.add(x, y, weights)
+    return accumulator.solve()
+
+
+def fit_to_meters(fit_pixel):
+    """
+    Convert a fit in pixel units to the equivalent fit in meters.
+
+    :param fit_pixel: polynomial coefficients (pixel)
+    :return: polynomial coefficients (meter)
+    """
+    a, b, c = fit_pixel
+    return np.array([xm_per_pix * a / ym_per_pix ** 2, xm_per_pix * b / ym_per_pix, xm_per_pix * c])
@@ -5,6 +5,8 @@ import sys
 sys.path.append('../')
 import cv2
 import numpy as np
+from functools import lru_cache
+from homography_utils import get_perspective_transforms
 
 # paper dimensions in inches
 PAPER_DIMENSIION_HEIGHT = 11
@@ -47,8 +49,8 @@ def four_point_transform(pts=None):
         [center_x - scale, center_y + scale * hwratio],  # bottom left
     ], dtype="float32")
 
-    # compute the perspective transform matrix and then apply it
-    M = cv2.getPerspectiveTransform(pts, dst)
+    # look up the cached perspective transform matrix
+    M, _ = get_perspective_transforms((max_height, max_width), pts, dst)
 
     return M
 
@@ -58,6 +60,30 @@ def apply_perspective_transformation(image):
     :param image: input image
     :return: image after perspective transform is applied
     '''
+    max_height = image.shape[0]
+    max_width = image.shape[1]
+
+    pts, dst = get_paper_points(max_height, max_width)
+
+    # look up the cached perspective transform matrix and then apply it
+    M, _ = get_perspective_transforms(image.shape, pts, dst)
+
+    try:
+        output = cv2.warpPerspective(image, M, (max_width, max_height))
+        return output
+    except:
+        return image
+
+
+@lru_cache(maxsize=None)
+def get_paper_points(max_height, max_width):
+    '''
+    Source and destination points used by apply_perspective_transformation
+
+    :param max_height: image height
+    :param max_width: image width
+    :return: read-only float32 source and destination points
+    '''
     final_top_left = (228, 170)
     final_top_right = (500, 210)
     final_bottom_left = (225, 325)
@@ -69,8 +95,6 @@ def apply_perspective_transformation(image):
                     final_bottom_left],
                    dtype="float32")
 
-    max_height = image.shape[0]
-    max_width = image.shape[1]
     hwratio = PAPER_DIMENSIION_HEIGHT / PAPER_DIMENSION_WIDTH  # letter size paper
     scale = int(max_width / PERSPECTIVE_TRANSFORM_SCALE_FACTOR)
 
@@ -84,11 +108,7 @@ def apply_perspective_transformation(image):
         [center_x - scale, center_y + scale * hwratio],  # bottom left
     ], dtype="float32")
 
-    # compute the perspective transform matrix and then apply it
-    M = cv2.getPerspectiveTransform(pts, dst)
+    pts.setflags(write=False)
+    dst.setflags(write=False)
 
-    try:
-        output = cv2.warpPerspective(image, M, (max_width, max_height))
-        return output
-    except:
-        return image
+    return pts, dst
@@ -0,0 +1,119 @@
+'''
+Debug visualization sinks
+
+Pipeline stages publish named debug images with publish(). What happens to
+them depends on the active sink:
+    HeadlessSink: images are dropped (default, use it for races)
+    DisplaySink: images are shown by a background thread, which keeps only the
+                 newest image of every window, so rendering and GUI events never
+                 hold up the control loop
+
+Published images are not copied, they must not be modified afterwards.
+'''
+
+import threading
+
+import cv2
+
+
+class HeadlessSink:
+    """
+    Sink dropping every image.
+    """
+    def publish(self, name, image):
+        pass
+
+    def quit_requested(self):
+        return False
+
+    def close(self):
+        pass
+
+
+class DisplaySink:
+    """
+    Sink showing images with cv2.imshow from a background thread.
+    """
+    def __init__(self, quit_key='q', refresh_period=0.03):
+        """
+        :param quit_key: key that makes quit_requested() return True
+        :param refresh_period: maximum time between two GUI event polls, in seconds
+        """
+        self.quit_key = quit_key
+        self.refresh_period = refresh_period
+
+        self._latest = {}
+        self._lock = threading.Lock()
+        self._updated = threading.Event()
+        self._stopped = threading.Event()
+        self._quit = threading.Event()
+
+        self._thread = threading.Thread(target=self._run, name='display-sink', daemon=True)
+        self._thread.start()
+
+    def publish(self, name, image):
+        # only the newest image per window is kept, older ones are dropped
+        with self._lock:
+            self._latest[name] = image
+        self._updated.set()
+
+    def quit_requested(self):
+        return self._quit.is_set()
+
+    def close(self):
+        self._stopped.set()
+        self._updated.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._updated.wait(self.refresh_period)
+            self._updated.clear()
+
+            with self._lock:
+                latest, self._latest = self._latest, {}
+
+            for name, image in latest.items():
+                cv2.imshow(name, image)
+
+            if cv2.waitKey(1) & 0xFF == ord(self.quit_key):
+                self._quit.set()
+
+        cv2.destroyAllWindows()
+
+
+_sink = HeadlessSink()
+
+
+def set_sink(sink):
+    """
+    Replace the active sink, closing the previous one.
+    """
+    global _sink
+    previous, _sink = _sink, sink
+    previous.close()
+
+
+def get_sink():
+    return _sink
+
+
+def publish(name, image):
+    """
+    Publish a debug image to the active sink.
+
+    :param name: channel (window) name
+    :param image: image to show
+    """
+    _sink.publish(name, image)
+
+
+def quit_requested():
+    return _sink.quit_requested()
+
+
+def close():
+    """
+    Close the active sink and fall back to headless mode.
+    """
+    set_sink(HeadlessSink())